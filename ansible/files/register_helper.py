@@ -6,16 +6,36 @@
 # pip install -U apscheduler
 # pip install -U shade
 # pip install flask_httpauth
+# pip install pyyaml (optional, for bulk registrations in YAML)
+#
+# The application is created by the create_app() factory, e.g.
+#
+# FLASK_APP='register_helper:create_app()' flask run
 
 # System imports
 import os
+import sys
+import logging
+import logging.handlers
 import pprint
 import ast
 import time
 import datetime
+import hashlib
+import threading
+import collections
+import re
+import csv
+import codecs
+import bisect
+import random
+
+# Thread pool used to query Ironic concurrently
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 # Flask web service imports
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, jsonify, request, abort, g
 from functools import wraps
 
 # HTTP Basic Authentication
@@ -27,31 +47,485 @@ from apscheduler.schedulers.background import BackgroundScheduler
 # Shade Cloud library
 import shade
 
-# Light Persistence
+# Light Persistence (shelve is only read to migrate former backups)
 import shelve
+import sqlite3
+
+# Election of the worker polling Ironic (not available on all platforms)
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
 
 # JSON library
 import json
 
+# YAML library (optional, only needed for bulk registrations in YAML)
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
 # Main Flask application handle
 app = Flask(__name__)
 # Authentication
 auth = HTTPBasicAuth()
 
+# Level of application logs
+log_level = os.getenv('REGISTER_HELPER_LOG_LEVEL', 'INFO').upper()
+# Ratio of machines whose details are logged on each poll (debug level)
+log_sample_rate = float(os.getenv('REGISTER_HELPER_LOG_SAMPLE_RATE', 0.1))
+# Optional file receiving logs as JSON lines
+log_json_file = os.getenv('REGISTER_HELPER_LOG_JSON')
+
+
+class JsonFormatter(logging.Formatter):
+    ''' Log records as JSON lines (fields given as extra are kept) '''
+
+    # Attributes common to all log records
+    record_attributes = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__.keys())
+    record_attributes.update(['message', 'asctime'])
+
+    def format(self, record):
+        entry = {
+            'ts': record.created,
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.record_attributes:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True, default=str)
+
+
+# Configure application logger (level and optional JSON sink)
+def _setup_logging():
+    global log_level, log_json_file
+    app.logger.setLevel(log_level)
+    if log_json_file:
+        handler = logging.handlers.WatchedFileHandler(log_json_file)
+        handler.setFormatter(JsonFormatter())
+        app.logger.addHandler(handler)
+
+
+_setup_logging()
+
+
+# Whether details of a machine are logged: debug level only and for a
+# sample of machines (records are neither formatted nor built otherwise)
+def _log_sampled():
+    global log_sample_rate
+    return (log_sample_rate > 0 and app.logger.isEnabledFor(logging.DEBUG) and
+            (log_sample_rate >= 1 or random.random() < log_sample_rate))
+
+
 # List of (un)registered machines
 registered_machines = {}
 todo_machines = {}
+# Reverse index of NICs: normalized MAC address -> Ironic UUID
+mac_index = {}
+# Index of names (registration and Ironic ones) and virt-uuid of registered
+# machines: name -> Ironic UUID
+name_index = {}
+# Machines deleted from Ironic: Ironic UUID -> shard name (ignored by polls
+# which started before deletion)
+unregistered_machines = {}
+# Fingerprints of last Ironic informations merged: Ironic UUID -> digest
+machine_digests = {}
+# Interval (in seconds) between refreshes (and persistence) of agent-last-seen
+# stamps of machines unchanged in Ironic
+last_seen_interval = float(os.getenv('REGISTER_HELPER_LAST_SEEN_INTERVAL', 300))
+# Internal counters of the agent
+agent_stats = {}
 first_call_to_shade = True
-shelve_db = None
+# Persistence store: SQLite database with one row per (un)registered machine
+persist_db = None
+persist_lock = threading.RLock()
+# Records modified since last persistence: set of (kind, key)
+dirty_objects = set()
+# Runs inventory changes (func, *args) -> result: None to run them in the
+# calling thread, single writer thread in asyncio serving mode (see
+# register_helper_async.py)
+inventory_writer = None
+# Rows of records as last loaded or written by this worker (base of merges
+# with changes of other workers): (kind, key) -> (version, JSON data)
+persisted_rows = {}
+# Incremented on each inventory change
+inventory_revision = 0
+# Serialized views of inventory (built once per revision)
+views = collections.OrderedDict()
+views_lock = threading.Lock()
+# Locks of views being built (only built once by concurrent requests)
+view_locks = {}
+# Maximum number of (filtered) views kept
+max_views = 64
+# Index of registered machines by provision state, role and tag
+inventory_index = {'revision': -1}
+# Notified after each batch of inventory changes
+inventory_cond = threading.Condition()
+# Maximum time (in seconds) a watch request can wait for changes
+max_wait = float(os.getenv('REGISTER_HELPER_MAX_WAIT', 300))
+# Callables also notified after each batch of inventory changes
+# (e.g. asyncio serving mode waking up watch requests)
+inventory_listeners = []
+# Interval (in seconds) between polls of Ironic inventory
+poll_interval = float(os.getenv('REGISTER_HELPER_POLL_INTERVAL', 30))
+# Retrieve base directory of Python script
+script_base_dir = os.path.dirname(os.path.realpath(__file__))
+script_filename = os.path.basename(__file__)
+# Persistence file will be stored in same directory with the prefix of Python
+# script name (without .py extension) with additional .sqlite extension
+persist_file = os.path.join(script_base_dir, os.path.splitext(script_filename)[0] + ".sqlite")
+# Former shelve backup (.db extension)
+shelve_file = os.path.join(script_base_dir, os.path.splitext(script_filename)[0] + ".db")
+# JSON bootstrapping status file (.json extension) and its data, merged once
+# Ironic inventory is retrieved
+bootstrap_file = os.path.join(script_base_dir, os.path.splitext(script_filename)[0] + ".json")
+bootstrap_data = {}
+# Workers (processes) share the persistence store: only the one holding
+# the lock on poll_lock_file polls Ironic and drives nodes
+poll_lock_file = os.path.join(script_base_dir, os.path.splitext(script_filename)[0] + ".lock")
+poll_lock_fd = None
+poll_leader = False
+# Interval (in seconds) between checks of changes made by other workers
+store_refresh_interval = float(os.getenv('REGISTER_HELPER_STORE_REFRESH_INTERVAL', 1))
+# Number of transactions committed into persistence store when last loaded
+# or written by this worker
+store_commits = 0
+# Shared revision up to which rows have been loaded (-1: none yet)
+store_revision = -1
+# Served inventory is the persisted one until Ironic has been polled
+inventory_stale = True
+# Application started (see create_app), background warm-up thread
+app_started = False
+app_started_lock = threading.Lock()
+warm_up_thread = None
+# Background jobs (started by create_app)
+scheduler = BackgroundScheduler()
+store_job = None
+poll_jobs = []
+driver_job = None
+# Metrics exposed by /metrics (Prometheus text format): name -> (type, help)
+metrics_help = collections.OrderedDict([
+    ('register_helper_poll_duration_seconds', ('histogram', 'Duration of Ironic inventory polls')),
+    ('register_helper_ironic_call_duration_seconds', ('histogram', 'Duration of Ironic API calls')),
+    ('register_helper_ironic_call_errors_total', ('counter', 'Failed Ironic API calls')),
+    ('register_helper_request_duration_seconds', ('histogram', 'Duration of HTTP requests')),
+    ('register_helper_response_size_bytes', ('histogram', 'Size of HTTP responses')),
+    ('register_helper_persist_duration_seconds', ('histogram', 'Duration of persistence store transactions')),
+    ('register_helper_keystone_auth_total', ('counter', 'HTTP authentications checked against keystone')),
+    ('register_helper_cloud_constructions_total', ('counter', 'Shade clouds built (authentications)')),
+    ('register_helper_patches_total', ('counter', 'Ironic patches of registered machines')),
+    ('register_helper_transitions_total', ('counter', 'Provisioning state transitions requested')),
+    ('register_helper_nodes', ('gauge', 'Registered nodes per provisioning state')),
+    ('register_helper_todo_machines', ('gauge', 'Pending registrations')),
+    ('register_helper_inventory_revision', ('gauge', 'Inventory revision')),
+    ('register_helper_inventory_stale', ('gauge', 'Whether Ironic has not been polled yet')),
+    ('register_helper_poll_leader', ('gauge', 'Whether this worker polls Ironic')),
+])
+# Upper bounds of histogram buckets
+duration_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+size_buckets = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+# Recorded metrics: (name, labels) -> counter value or histogram
+# [counts per bucket, sum, count, buckets]
+metrics = {}
+metrics_lock = threading.Lock()
+
+
+# Key of a metric: (name, sorted tuple of (label, value))
+def _metric_key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+# Record an observation into a histogram
+def _observe(name, value, buckets=duration_buckets, **labels):
+    global metrics, metrics_lock
+    key = _metric_key(name, labels)
+    idx = bisect.bisect_left(buckets, value)
+    with metrics_lock:
+        hist = metrics.get(key)
+        if hist is None:
+            hist = metrics[key] = [[0] * (len(buckets) + 1), 0.0, 0, buckets]
+        hist[0][idx] += 1
+        hist[1] += value
+        hist[2] += 1
+
+
+# Increment a counter
+def _count(name, value=1, **labels):
+    global metrics, metrics_lock
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        metrics[key] = metrics.get(key, 0) + value
+
+
+# Labels of a metric sample in Prometheus text format
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+# All metrics in Prometheus text format (gauges are computed right now)
+def _render_metrics():
+    global metrics, metrics_lock, todo_machines
+    with persist_lock:
+        samples = dict((_metric_key('register_helper_nodes', {'provision_state': state}), len(uuids))
+                       for state, uuids in _get_inventory_index()['state'].items())
+        samples[_metric_key('register_helper_todo_machines', {})] = len(todo_machines)
+    samples[_metric_key('register_helper_inventory_revision', {})] = inventory_revision
+    samples[_metric_key('register_helper_inventory_stale', {})] = 1 if inventory_stale else 0
+    samples[_metric_key('register_helper_poll_leader', {})] = 1 if poll_leader else 0
+    with metrics_lock:
+        for key, value in metrics.items():
+            samples[key] = (list(value[0]), value[1], value[2], value[3]) if isinstance(value, list) else value
+    series = {}
+    for (name, labels), value in samples.items():
+        series.setdefault(name, []).append((labels, value))
+    lines = []
+    for name, (mtype, mhelp) in metrics_help.items():
+        if name not in series:
+            continue
+        lines.append('# HELP {} {}'.format(name, mhelp))
+        lines.append('# TYPE {} {}'.format(name, mtype))
+        for labels, value in sorted(series[name]):
+            if mtype != 'histogram':
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+                continue
+            counts, total, count, buckets = value
+            cumulated = 0
+            for bound, bucket_count in zip(buckets + [float('inf')], counts):
+                cumulated += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', le),)), cumulated))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), repr(total)))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+# Size of chunks read from bulk registration requests
+bulk_chunk_size = 65536
+# Valid MAC addresses (once normalized)
+mac_regex = re.compile(r'^([0-9a-f]{2}[:-]){5}[0-9a-f]{2}$')
+# String types (unicode included for python 2)
+string_types = (str, type(u''))
+
+
+# Persisted dictionnary corresponding to a kind of record
+def _persisted_dict(kind):
+    global registered_machines, todo_machines
+    return {'registered': registered_machines, 'todo': todo_machines}.get(kind)
+
+
+# Open (and create if needed) persistence store
+# (write-ahead log lets workers read while another one writes)
+# Each row has a version (incremented on each write) and the shared
+# revision at which it was last written, deleted records are kept as 'null'
+# rows so that workers only load rows changed since their last load
+def _open_persisted_objects(db_file):
+    db = sqlite3.connect(db_file, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    with db:
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('CREATE TABLE IF NOT EXISTS machines ('
+                   'kind TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, '
+                   'version INTEGER NOT NULL DEFAULT 0, revision INTEGER NOT NULL DEFAULT 0, '
+                   'PRIMARY KEY (kind, key))')
+        # Stores created by former versions
+        columns = set(row[1] for row in db.execute('PRAGMA table_info(machines)'))
+        for column in ['version', 'revision']:
+            if column not in columns:
+                db.execute('ALTER TABLE machines ADD COLUMN {} INTEGER NOT NULL DEFAULT 0'.format(column))
+        db.execute('CREATE INDEX IF NOT EXISTS machines_revision ON machines (revision)')
+        # Inventory revision (shared by workers), number of transactions,
+        # whether Ironic has been polled since polling worker started and
+        # revision at which deleted rows were last purged
+        db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        db.execute("INSERT OR IGNORE INTO meta (name, value) VALUES "
+                   "('revision', 0), ('commits', 0), ('ready', 0), ('purged', 0)")
+    return db
+
+
+# Persistence store counters: (commits, revision, purged)
+def _persisted_counters():
+    global persist_db
+    counters = dict(persist_db.execute('SELECT name, value FROM meta'))
+    return counters.get('commits', 0), counters.get('revision', 0), counters.get('purged', 0)
+
+
+# Remove rows of deleted records (workers which did not load them yet
+# reload all rows)
+def _purge_persisted_objects():
+    global persist_db
+    with persist_lock:
+        with persist_db:
+            persist_db.execute("DELETE FROM machines WHERE data = 'null'")
+            persist_db.execute("UPDATE meta SET value = (SELECT value FROM meta WHERE name = 'revision') "
+                               "WHERE name = 'purged'")
 
 
-# Update objects to be persisted
+# Record whether persisted state is synchronized with Ironic
+def _set_persisted_ready(ready):
+    global persist_db
+    if persist_db is None:
+        return
+    with persist_lock:
+        with persist_db:
+            persist_db.execute("UPDATE meta SET value = ? WHERE name = 'ready'", (1 if ready else 0,))
+
+
+# Replace record in current memory (None if deleted) keeping indexes up
+# to date. Nodes whose unregistration was requested or whose state changed
+# are driven right away by the polling worker
+def _set_persisted_object(kind, key, obj):
+    global machine_digests, poll_leader
+    objects = _persisted_dict(kind)
+    old = objects.pop(key, None) if obj is None else objects.get(key)
+    if obj is not None:
+        objects[key] = obj
+    if kind == 'registered':
+        _index_machine_nics(key, (old or {}).get('nics', []), (obj or {}).get('nics', []))
+        _index_machine_names(key, _machine_names(old or {}), _machine_names(obj or {}))
+        if poll_leader and old is not None and obj is not None and any(
+                obj.get(k) != old.get(k) for k in ['agent-unregistering', 'provision_state']):
+            _wake_node(key)
+    # Changed by another worker: merge again on next poll
+    machine_digests.pop(key, None)
+
+
+# Three-way merge of a record written by another worker (stored) since
+# this one loaded it (base): entries changed locally are kept, other ones
+# are taken from stored record. A record deleted on either side stays
+# deleted unless it has been created again locally
+def _merge_persisted_object(base, local, stored):
+    if local is None or stored is None:
+        return local if base is None else None
+    merged = dict(stored)
+    for k in set(base or {}) | set(local):
+        if k not in local:
+            merged.pop(k, None)
+        elif base is None or k not in base or local[k] != base[k]:
+            merged[k] = local[k]
+    return merged
+
+
+# Load persisted objects changed since last load into current memory
+# (records modified but not persisted yet by this worker are kept, rows
+# already loaded or written by this worker are not decoded again)
+def _load_persisted_objects():
+    global persist_db, dirty_objects, persisted_rows, inventory_revision, store_commits, store_revision
+    with persist_lock:
+        with persist_db:
+            # Consistent snapshot of counters and records
+            persist_db.execute('BEGIN')
+            commits, revision, purged = _persisted_counters()
+            # Deleted rows not loaded yet may have been purged: load all rows
+            full = store_revision < purged
+            rows = persist_db.execute('SELECT kind, key, data, version FROM machines WHERE revision > ?',
+                                      (-1 if full else store_revision,)).fetchall()
+        loaded = set()
+        for kind, key, data, version in rows:
+            loaded.add((kind, key))
+            if _persisted_dict(kind) is None or (kind, key) in dirty_objects:
+                continue
+            if persisted_rows.get((kind, key), (None, None))[0] != version:
+                _set_persisted_object(kind, key, json.loads(data))
+                persisted_rows[(kind, key)] = (version, data)
+        if full:
+            for kind in ['registered', 'todo']:
+                for key in list(_persisted_dict(kind).keys()):
+                    if (kind, key) not in loaded and (kind, key) not in dirty_objects:
+                        _set_persisted_object(kind, key, None)
+                        persisted_rows.pop((kind, key), None)
+        store_commits = commits
+        store_revision = revision
+        inventory_revision = max(inventory_revision + 1, revision)
+        return len(rows) > 0
+
+
+# Apply inventory change (see inventory_writer): Ironic calls are made
+# by callers, never by changes
+def _write(func, *args):
+    global inventory_writer
+    if inventory_writer is None:
+        return func(*args)
+    return inventory_writer(func, *args)
+
+
+# Record needs to be persisted (or deleted if it does not exist anymore)
+def _mark_dirty(kind, key):
+    global dirty_objects, inventory_revision
+    with persist_lock:
+        dirty_objects.add((kind, key))
+        inventory_revision += 1
+
+
+# Update objects to be persisted: only modified records are written
+# within a single transaction. Records written by another worker since
+# loaded (version changed) are merged with the stored ones instead of
+# overwriting them
 def _update_persisted_objects():
-    global shelve_db, registered_machines, todo_machines
-    if not shelve_db is None:
-        shelve_db['registered_machines'] = registered_machines
-        shelve_db['todo_machines'] = todo_machines
-        shelve_db.sync()
+    global persist_db, dirty_objects, persisted_rows, inventory_revision, store_commits, store_revision
+    with persist_lock:
+        if len(dirty_objects) == 0:
+            return
+        dirty = dirty_objects
+        dirty_objects = set()
+        start = time.time()
+        try:
+            if persist_db is not None:
+                with persist_db:
+                    # Shared revision (and number of transactions) are
+                    # incremented first, locking store until commit
+                    persist_db.execute("UPDATE meta SET value = value + 1 WHERE name = 'commits'")
+                    persist_db.execute("UPDATE meta SET value = MAX(value + 1, ?) WHERE name = 'revision'",
+                                       (inventory_revision,))
+                    commits, revision, purged = _persisted_counters()
+                    written = {}
+                    for kind, key in dirty:
+                        obj = _persisted_dict(kind).get(key)
+                        version, base = persisted_rows.get((kind, key), (0, None))
+                        row = persist_db.execute('SELECT version, data FROM machines WHERE kind = ? AND key = ?',
+                                                 (kind, key)).fetchone()
+                        stored_version, stored = row if row is not None else (0, None)
+                        if stored_version != version:
+                            obj = _merge_persisted_object(json.loads(base) if base else None, obj,
+                                                          json.loads(stored) if stored else None)
+                            _set_persisted_object(kind, key, obj)
+                            app.logger.info('Record %s %s changed by another worker: merged', kind, key)
+                        if obj is None and stored in (None, 'null'):
+                            continue
+                        # Deleted records are kept as 'null' rows
+                        data = json.dumps(obj, default=str)
+                        persist_db.execute('INSERT OR REPLACE INTO machines (kind, key, data, version, revision) '
+                                           'VALUES (?, ?, ?, ?, ?)', (kind, key, data, stored_version + 1, revision))
+                        written[(kind, key)] = (stored_version + 1, data)
+                persisted_rows.update(written)
+                inventory_revision = revision
+                # Changes of other workers not loaded yet otherwise
+                if commits == store_commits + 1:
+                    store_commits = commits
+                    store_revision = revision
+                _observe('register_helper_persist_duration_seconds', time.time() - start)
+        except Exception:
+            # Transaction was rolled back: retry on next update
+            dirty_objects |= dirty
+            raise
+        finally:
+            # Wake up watchers
+            with inventory_cond:
+                inventory_cond.notify_all()
+            for listener in inventory_listeners:
+                listener()
 
 
 # Get shade library credentials
@@ -73,15 +547,217 @@ def _get_shade_auth():
     return options
 
 
+# Ironic endpoints (shards) polled: name -> shade options
+# REGISTER_HELPER_IRONIC_ENDPOINTS lists comma separated name=URL entries of
+# bifrost Ironic endpoints (reached without keystone), otherwise the single
+# endpoint of shade credentials is polled (unnamed shard)
+def _get_shards():
+    shards = collections.OrderedDict()
+    for entry in os.getenv('REGISTER_HELPER_IRONIC_ENDPOINTS', '').split(','):
+        if not entry.strip():
+            continue
+        name, sep, url = [v.strip() for v in entry.partition('=')]
+        if not sep or not re.match(r'^[\w.-]+$', name) or not url:
+            raise ValueError('Invalid Ironic endpoint {} (name=URL expected)'.format(entry))
+        shards[name] = dict(auth_type="None", auth=dict(endpoint=url))
+    if len(shards) == 0:
+        shards[''] = None
+    return shards
+
+
 # Compute it only once
 shade_opts = _get_shade_auth()
+shards = _get_shards()
+# Polls of each shard: name -> {'ts', 'success-ts', 'error', 'failures', 'machines', 'retry-ts'}
+shard_status = {}
+# Shards which must have been polled successfully before inventory is
+# considered synchronized (comma separated names, '*' for all of them):
+# other ones only need to have been polled once, a shard which can not be
+# reached does not keep the whole inventory stale
+required_shards = [name.strip() for name in os.getenv('REGISTER_HELPER_REQUIRED_SHARDS', '').split(',')
+                   if name.strip()]
+# Ironic endpoint of known nodes: Ironic UUID -> shard name
+node_shards = {}
+
+# Number of concurrent per-node Ironic calls during polls
+fetch_workers = max(1, int(os.getenv('REGISTER_HELPER_FETCH_WORKERS', 8)))
+# Maximum time (in seconds) to wait for each per-node Ironic call
+fetch_timeout = float(os.getenv('REGISTER_HELPER_FETCH_TIMEOUT', 30))
+# Client side timeout (in seconds) of each Ironic and keystone HTTP request
+api_timeout = float(os.getenv('REGISTER_HELPER_API_TIMEOUT', fetch_timeout))
+# Pools of threads (one per shard): shard name -> pool
+fetch_pools = {}
+
+# Provisioning state-machine driver: node is moved from a state to the next one
+provision_transitions = {'enroll': 'manage', 'manageable': 'provide', 'available': 'active'}
+# States which are polled with exponential backoff (transitional states are polled quickly)
+# Failure states without transition are left until fixed by an operator
+stable_states = ['active', 'deploy failed', 'error', 'clean failed', 'inspect failed', 'rescue failed',
+                 'unrescue failed', 'adopt failed']
+# States in which nodes being unregistered are deleted from Ironic or torn
+# down first
+deletable_states = ['enroll', 'manageable', 'available', 'adopt failed']
+teardown_states = ['active', 'deploy failed', 'error']
+# Fields of machines refreshed when driving nodes
+driven_fields = ['provision_state', 'target_provision_state', 'power_state', 'target_power_state', 'last_error']
+# Interval (in seconds) between checks of nodes to be driven
+driver_interval = float(os.getenv('REGISTER_HELPER_DRIVER_INTERVAL', 1))
+# Number of nodes driven concurrently
+transition_workers = max(1, int(os.getenv('REGISTER_HELPER_TRANSITION_WORKERS', 8)))
+# Poll interval of nodes in transitional states and maximum one of stable nodes
+fast_poll_interval = float(os.getenv('REGISTER_HELPER_FAST_POLL_INTERVAL', 2))
+max_poll_backoff = float(os.getenv('REGISTER_HELPER_MAX_POLL_BACKOFF', 300))
+transition_pool = None
+# Next poll of nodes: Ironic UUID -> {'next': timestamp, 'delay': seconds}
+node_schedule = {}
+# Nodes currently driven
+nodes_in_flight = set()
+# Current provision state of nodes: Ironic UUID -> {'state': state, 'since': timestamp}
+node_states = {}
+schedule_lock = threading.RLock()
+
+# Long-lived shade clouds: the operator one (key None) shared by polls and
+# patches and the ones of shards (('shard', name) keys)
+clouds = {}
+# Clouds of user credentials used for HTTP authentication (credentials key
+# -> cloud), least recently used first
+user_clouds = collections.OrderedDict()
+clouds_lock = threading.Lock()
+# Maximum number of per user clouds kept
+max_user_clouds = 16
+# Secret salt used to hash user credentials kept in memory
+credentials_salt = os.urandom(16)
+
+
+# Cache of HTTP authentication results: successful ones are kept
+# auth_cache_ttl seconds, failed ones auth_cache_negative_ttl seconds
+auth_cache = collections.OrderedDict()
+auth_cache_lock = threading.Lock()
+auth_cache_ttl = float(os.getenv('REGISTER_HELPER_AUTH_CACHE_TTL', 300))
+auth_cache_negative_ttl = float(os.getenv('REGISTER_HELPER_AUTH_CACHE_NEGATIVE_TTL', 5))
+auth_cache_size = int(os.getenv('REGISTER_HELPER_AUTH_CACHE_SIZE', 128))
+
+
+# Non reversible key of user credentials
+def _credentials_key(username, password):
+    global credentials_salt
+    hkey = hashlib.sha256(credentials_salt)
+    for v in [username, password]:
+        hkey.update((v or u'').encode('utf-8'))
+        hkey.update(b'\0')
+    return hkey.hexdigest()
+
+
+# Get (and build if needed) a shared shade cloud
+# A stale cloud (e.g. with expired token) given as parameter is replaced
+def _get_cloud(key=None, opts=None, stale=None):
+    global clouds, user_clouds, clouds_lock, shade_opts, agent_stats, max_user_clouds
+    # Operator cloud has key None, shard ones are tuples
+    kind = 'operator' if key is None else 'shard' if isinstance(key, tuple) else 'user'
+    with clouds_lock:
+        if kind == 'user':
+            cloud = user_clouds.pop(key, None)
+        else:
+            cloud = clouds.get(key)
+        if cloud is None or cloud is stale:
+            if kind == 'user':
+                # Forget least recently used user clouds
+                while len(user_clouds) >= max_user_clouds:
+                    user_clouds.popitem(last=False)
+            # Calls never hang pool threads forever
+            cloud = shade.operator_cloud(api_timeout=api_timeout, **(opts or shade_opts))
+            cstats = agent_stats.setdefault('cloud', {'constructions': 0, 'refreshes': 0})
+            cstats['constructions'] += 1
+            if stale is not None:
+                cstats['refreshes'] += 1
+            _count('register_helper_cloud_constructions_total', kind=kind,
+                   reason='new' if stale is None else 'refresh')
+        if kind == 'user':
+            # Most recently used clouds are kept at the end
+            user_clouds[key] = cloud
+        else:
+            clouds[key] = cloud
+        return cloud
+
+
+# Forget a shared shade cloud (e.g. built with invalid credentials)
+def _forget_cloud(key):
+    global clouds, user_clouds, clouds_lock
+    with clouds_lock:
+        clouds.pop(key, None)
+        user_clouds.pop(key, None)
+
+
+# Authentication failures (token expiry, revoked credentials, ...)
+def _is_auth_error(e):
+    for status in [getattr(e, 'http_status', None),
+                   getattr(e, 'status_code', None),
+                   getattr(getattr(e, 'response', None), 'status_code', None)]:
+        if status == 401:
+            return True
+    return type(e).__name__ == 'Unauthorized'
+
+
+# Call shade cloud method, re-authenticating once if needed
+# (cloud of given shard, of given credentials or operator one)
+def _call_cloud(method, *args, **kwargs):
+    key = kwargs.pop('key', None)
+    opts = kwargs.pop('opts', None)
+    shard = kwargs.pop('shard', None)
+    if shard:
+        key, opts = ('shard', shard), shards[shard]
+    start = time.time()
+    try:
+        cloud = _get_cloud(key, opts)
+        try:
+            return getattr(cloud, method)(*args, **kwargs)
+        except Exception as e:
+            if not _is_auth_error(e):
+                raise
+            app.logger.warning('Refreshing cloud after authentication failure: %s', e)
+            return getattr(_get_cloud(key, opts, stale=cloud), method)(*args, **kwargs)
+    except Exception:
+        _count('register_helper_ironic_call_errors_total', method=method)
+        raise
+    finally:
+        _observe('register_helper_ironic_call_duration_seconds', time.time() - start, method=method)
+
+
+# Retrieve cached authentication result (None if unknown or expired)
+def _auth_cache_get(ckey):
+    global auth_cache, auth_cache_lock, agent_stats
+    with auth_cache_lock:
+        cstats = agent_stats.setdefault('auth_cache', {'hits': 0, 'misses': 0})
+        entry = auth_cache.get(ckey)
+        if entry is None or entry[1] < time.time():
+            auth_cache.pop(ckey, None)
+            cstats['misses'] += 1
+            return None
+        # Least recently used entries are at the beginning
+        del auth_cache[ckey]
+        auth_cache[ckey] = entry
+        cstats['hits'] += 1
+        return entry[0]
+
+
+# Store authentication result evicting least recently used entries
+def _auth_cache_put(ckey, result):
+    global auth_cache, auth_cache_lock, auth_cache_ttl, auth_cache_negative_ttl, auth_cache_size
+    ttl = auth_cache_ttl if result else auth_cache_negative_ttl
+    if ttl <= 0 or auth_cache_size <= 0:
+        return
+    with auth_cache_lock:
+        auth_cache.pop(ckey, None)
+        auth_cache[ckey] = (result, time.time() + ttl)
+        while len(auth_cache) > auth_cache_size:
+            auth_cache.popitem(last=False)
 
 
 # HTTP Authentication
 @auth.verify_password
 def verify_password(username, password):
     global shade_opts
-    app.logger.debug('******************** Checking user {} password {}'.format(username, password))
+    app.logger.debug('Checking user %s', username)
 
     # No auth aka keystone not configured: service is left unsecured
     if shade_opts.get('auth_type', None) == "None":
@@ -96,13 +772,22 @@ def verify_password(username, password):
         # TODO: see if the following line should be uncommented and add
         # more security but simple HTTP Auth only supports user:passwd
         # my_auth['auth']['project_name'] = os.getenv('OS_PROJECT_NAME', "")
+        ckey = _credentials_key(username, password)
+        # Credentials recently checked
+        cached = _auth_cache_get(ckey)
+        if cached is not None:
+            return cached
         try:
-            cloud = shade.operator_cloud(**my_auth)
-            machines = cloud.list_machines()
+            _call_cloud('list_machines', key=ckey, opts=my_auth)
         except Exception as e:
-            app.logger.error('verify_password Got exception: {}'.format(e))
+            app.logger.warning('verify_password Got exception: %s', e, extra={'user': username})
+            _forget_cloud(ckey)
+            _auth_cache_put(ckey, False)
+            _count('register_helper_keystone_auth_total', result='rejected')
             return False
         # Authorized access
+        _auth_cache_put(ckey, True)
+        _count('register_helper_keystone_auth_total', result='accepted')
         return True
     # Unauthorized access
     return False
@@ -120,39 +805,118 @@ def requires_auth(f):
         if shade_opts.get('auth_type', None) == "password":
             auth = request.authorization
             if not auth:  # no header set
-                app.logger.error('requires_auth no auth info from {}'.format(
-                    request.remote_addr))
+                app.logger.warning('requires_auth no auth info from %s', request.remote_addr)
                 abort(401)
             if not verify_password(auth.username, auth.password):
-                app.logger.error('requires_auth bad auth info from {} user {}'.format(
-                    request.remote_addr, auth.username))
+                app.logger.warning('requires_auth bad auth info from %s user %s',
+                                   request.remote_addr, auth.username)
                 abort(401)
         return f(*args, **kwargs)
     return decorated
 
 
-def _find_machine(mac_addr):
-    global registered_machines
-    app.logger.debug('******************** Looking for machine with MAC address {}'.format(mac_addr))
-    if not mac_addr:
+# MAC addresses are compared lowercase whatever the source
+# (Ironic ports, registration requests, bootstrap file)
+def _normalize_mac(mac_addr):
+    global string_types
+    if not mac_addr or not isinstance(mac_addr, string_types):
         return None
-    for key, value in registered_machines.items():
-        if mac_addr in value.get('nics', []):
-            app.logger.debug('Found {} in {}'.format(mac_addr, key))
-            return key
-    return None
+    return mac_addr.strip().lower()
 
 
-def _patch_machine(uuid, vid, changes):
-    global registered_machines, shade_opts
+# Update MAC index with the current list of NICs of a machine
+# (stale entries pointing to this machine are removed)
+def _index_machine_nics(uuid, old_nics, new_nics):
+    global mac_index
+    new_macs = set(filter(None, map(_normalize_mac, new_nics or [])))
+    for mac in map(_normalize_mac, old_nics or []):
+        if mac and mac not in new_macs and mac_index.get(mac) == uuid:
+            del mac_index[mac]
+    for mac in new_macs:
+        mac_index[mac] = uuid
+
+
+# Remove all NICs of a machine from MAC index
+def _unindex_machine_nics(uuid, nics):
+    _index_machine_nics(uuid, nics, [])
+
+
+# Names under which a registered machine can be designated (also qualified
+# by shard name: <shard>/<name>)
+def _machine_names(machine):
+    names = set(n for n in [machine.get('kvm-name'), machine.get('name'), machine.get('virt-uuid')] if n)
+    if machine.get('agent-shard'):
+        names.update(['{}/{}'.format(machine['agent-shard'], n) for n in names])
+    return names
+
+
+# Shard of a node (Ironic endpoint to call)
+def _shard_of(uuid):
+    global node_shards, registered_machines
+    return node_shards.get(uuid) or registered_machines.get(uuid, {}).get('agent-shard', '')
+
+
+# Update name index with the current names of a machine
+def _index_machine_names(uuid, old_names, new_names):
+    global name_index
+    for name in old_names - new_names:
+        if name_index.get(name) == uuid:
+            del name_index[name]
+    for name in new_names:
+        name_index[name] = uuid
+
+
+# Recompute MAC and name indexes from scratch (after state restoration)
+def _rebuild_indexes():
+    global mac_index, name_index, registered_machines
+    mac_index = {}
+    name_index = {}
+    for uuid, machine in registered_machines.items():
+        _index_machine_nics(uuid, [], machine.get('nics', []))
+        _index_machine_names(uuid, set(), _machine_names(machine))
+
+
+# Find record designated by Ironic UUID, name, virt-uuid or MAC address:
+# ('registered', Ironic UUID), ('todo', virt-uuid) or (None, None)
+def _resolve_machine(machineid):
+    global registered_machines, todo_machines, name_index, mac_index
+    mac_addr = _normalize_mac(machineid)
+    if machineid in registered_machines:
+        return 'registered', machineid
+    uuid = name_index.get(machineid) or mac_index.get(mac_addr)
+    if uuid in registered_machines:
+        return 'registered', uuid
+    if machineid in todo_machines:
+        return 'todo', machineid
+    # Pending registrations are few: no index
+    for vid, machine in todo_machines.items():
+        if machine.get('name') == machineid or _normalize_mac(machine.get('mac_addr')) == mac_addr:
+            return 'todo', vid
+    return None, None
+
+
+def _find_machine(mac_addr):
+    global mac_index
+    key = mac_index.get(_normalize_mac(mac_addr))
+    app.logger.debug('Looking for machine with MAC address %s: %s', mac_addr, key)
+    return key
+
+
+# Apply requested changes to the locally registered machine and
+# compute the corresponding Ironic JSON patch
+def _build_machine_patch(uuid, vid, changes):
+    global registered_machines
     # Convert unicode to string
     # uuid = uuid.encode('ascii', 'ignore')
-    app.logger.error('==================== _patch_machine {} {} {}'.format(uuid, vid, changes))
+    app.logger.debug('_build_machine_patch %s %s %s', uuid, vid, changes)
     patch = []
+    _mark_dirty('registered', uuid)
+    names = _machine_names(registered_machines[uuid])
     if 'name' in changes:
         registered_machines[uuid]['kvm-name'] = changes['name']
     if 'virt-uuid' in changes:
         registered_machines[uuid]['virt-uuid'] = changes['virt-uuid']
+    _index_machine_names(uuid, names, _machine_names(registered_machines[uuid]))
     if 'vnc_host' in changes and 'vnc_port' in changes:
         registered_machines[uuid]['vnc-info'] = "{}:{}".format(
             changes['vnc_host'], changes['vnc_port'])
@@ -200,38 +964,443 @@ def _patch_machine(uuid, vid, changes):
             'path': '/extra/tags',
             'value': changes['tags']
         })
+    return patch
+
+
+# Send Ironic patch of a registered machine
+def _apply_machine_patch(uuid, patch):
     if len(patch) > 0:
-        cloud = shade.operator_cloud(**shade_opts)
-        cloud.patch_machine(uuid, patch)
+        try:
+            _call_cloud('patch_machine', uuid, patch, shard=_shard_of(uuid))
+        except Exception:
+            _count('register_helper_patches_total', result='failed')
+            raise
+        _count('register_helper_patches_total', result='applied')
+
+
+def _patch_machine(uuid, vid, changes):
+    _apply_machine_patch(uuid, _build_machine_patch(uuid, vid, changes))
     return True
 
 
-# Retrieve baremetal informations via shade library
+# Forget a machine deleted from Ironic (record, indexes and schedule)
+def _forget_machine(uuid):
+    global registered_machines, machine_digests, unregistered_machines, node_schedule, node_states, agent_stats
+    with persist_lock:
+        shard = _shard_of(uuid)
+        machine = registered_machines.pop(uuid, None)
+        if machine is not None:
+            _unindex_machine_nics(uuid, machine.get('nics', []))
+            _index_machine_names(uuid, _machine_names(machine), set())
+            _mark_dirty('registered', uuid)
+        machine_digests.pop(uuid, None)
+        node_shards.pop(uuid, None)
+        unregistered_machines[uuid] = shard
+        _update_persisted_objects()
+    with schedule_lock:
+        node_schedule.pop(uuid, None)
+        node_states.pop(uuid, None)
+        agent_stats.get('time_in_state', {}).pop(uuid, None)
+
+
+# Delete machine from Ironic (with its ports) then forget it
+def _unregister_machine(uuid):
+    global registered_machines
+    nics = registered_machines.get(uuid, {}).get('nics', [])
+    _call_cloud('unregister_machine', [{'mac': mac} for mac in nics], uuid, shard=_shard_of(uuid))
+    app.logger.info('Machine %s unregistered', uuid, extra={'uuid': uuid})
+    _write(_forget_machine, uuid)
+
+
+# Pending registrations matching machines known by Ironic (local records
+# are updated right away): returns list of (virt-uuid, Ironic UUID,
+# registration, Ironic patch) and number of other registrations
+def _pending_patches():
+    global todo_machines
+    batch = []
+    skipped = 0
+    with persist_lock:
+        for vid, changes in todo_machines.items():
+            uuid = _find_machine(changes.get('mac_addr', None))
+            # No machine with same MAC address known by Ironic yet
+            if not uuid:
+                skipped += 1
+                continue
+            app.logger.info('Machine vid %s needs to be updated (uuid %s)', vid, uuid, extra={'vid': vid, 'uuid': uuid})
+            app.logger.debug('Machine vid %s changes: %s', vid, changes)
+            batch.append((vid, uuid, changes, _build_machine_patch(uuid, vid, changes)))
+        _update_persisted_objects()
+    return batch, skipped
+
+
+# Remove patched registrations (unless registered again meanwhile)
+def _drop_registrations(applied):
+    global todo_machines
+    with persist_lock:
+        for vid, changes in applied:
+            if todo_machines.get(vid) is changes:
+                del todo_machines[vid]
+                _mark_dirty('todo', vid)
+        _update_persisted_objects()
+
+
+# Match pending registrations against the MAC index in a single pass
+# then send all resulting Ironic patches as one batch (registrations and
+# records are only changed by inventory writer, not while patching)
+def _reconcile_todo_machines():
+    global agent_stats
+    batch, skipped = _write(_pending_patches)
+    stats = {'applied': 0, 'skipped': skipped, 'failed': 0}
+    applied = []
+    for vid, uuid, changes, patch in batch:
+        try:
+            if len(patch) > 0:
+                _call_cloud('patch_machine', uuid, patch, shard=_shard_of(uuid))
+        except Exception as e:
+            # Registration is kept and will be retried on next poll
+            app.logger.error('Got exception patching machine vid %s uuid %s: %s', vid, uuid, e,
+                             extra={'vid': vid, 'uuid': uuid})
+            stats['failed'] += 1
+            _count('register_helper_patches_total', result='failed')
+            continue
+        applied.append((vid, changes))
+        stats['applied'] += 1
+        _count('register_helper_patches_total', result='applied')
+    if len(applied) > 0:
+        _write(_drop_registrations, applied)
+    # Only logged when some registrations are pending
+    app.logger.log(logging.INFO if len(batch) > 0 or stats['skipped'] > 0 else logging.DEBUG,
+                   'Pending registrations: %d applied %d skipped %d failed',
+                   stats['applied'], stats['skipped'], stats['failed'], extra={'reconcile': dict(stats)})
+    stats['ts'] = time.time()
+    agent_stats['reconcile'] = stats
+    return stats
+
+
+# Bounded pool of threads shared by all polls of a shard (slow shards do
+# not delay other ones)
+def _get_fetch_pool(shard=''):
+    global fetch_pools, fetch_workers
+    with clouds_lock:
+        if shard not in fetch_pools:
+            fetch_pools[shard] = ThreadPool(fetch_workers)
+        return fetch_pools[shard]
+
+
+# Call shade cloud method unless deadline has passed (calls queued behind
+# hung ones are dropped instead of delaying next polls)
+def _call_cloud_before(deadline, method, *args, **kwargs):
+    if time.time() > deadline:
+        raise multiprocessing.TimeoutError('Deadline passed before {} could be called'.format(method))
+    return _call_cloud(method, *args, **kwargs)
+
+
+# Issue per-node Ironic calls concurrently within fetch_timeout for the
+# whole stage: returns dict of results by UUID (nodes whose call failed or
+# did not complete in time are left out and handled on next poll)
+def _fetch_per_node(method, uuids, shard=''):
+    global fetch_timeout
+    pool = _get_fetch_pool(shard)
+    deadline = time.time() + fetch_timeout
+    pending = [(uuid, pool.apply_async(_call_cloud_before, (deadline, method, uuid), {'shard': shard}))
+               for uuid in uuids]
+    results = {}
+    timed_out = 0
+    for uuid, res in pending:
+        try:
+            results[uuid] = res.get(max(0, deadline - time.time()))
+        except multiprocessing.TimeoutError:
+            timed_out += 1
+        except Exception as e:
+            app.logger.error('Got exception calling %s for node %s: %s', method, uuid, e, extra={'uuid': uuid})
+    if timed_out > 0:
+        app.logger.error('%d calls of %s not completed within %.1fs', timed_out, method, fetch_timeout,
+                         extra={'shard': shard, 'timed_out': timed_out})
+    return results
+
+
+# Fingerprint of Ironic informations of a machine: nodes and ports are
+# stamped by Ironic (updated_at) whenever they change
+def _machine_digest(machine, nics):
+    return (machine.get('updated_at'), machine.get('provision_state'), machine.get('power_state'),
+            tuple((nic.get('address'), nic.get('updated_at')) for nic in nics))
+
+
+# Machine still known by Ironic: agent-last-seen stamps are refreshed (and
+# persisted) once per last_seen_interval
+def _machine_seen(uuid):
+    global registered_machines, last_seen_interval
+    machine = registered_machines[uuid]
+    now = time.time()
+    if now - machine.get('agent-last-seen-ts', machine.get('agent-stored-ts', 0)) < last_seen_interval:
+        return
+    machine['agent-last-seen-ts'] = now
+    machine['agent-last-seen'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    _mark_dirty('registered', uuid)
+
+
+# Compact change-set between former and new machine informations
+# (keys missing from new informations are kept as is)
+def _machine_changes(old_machine, new_machine):
+    return dict((k, v) for k, v in new_machine.items() if k not in old_machine or old_machine[k] != v)
+
+
+# Registered machine was discovered or modified
+def _machine_changed(uuid, changes):
+    if _log_sampled():
+        app.logger.debug('Machine %s changes: %s', uuid, changes)
+    _mark_dirty('registered', uuid)
+    if 'provision_state' in changes:
+        _record_state(uuid, changes['provision_state'])
+        # Drive node right away
+        _wake_node(uuid)
+
+
+# Record time spent by node in its former provision state
+def _record_state(uuid, state):
+    global node_states, agent_stats
+    now = time.time()
+    with schedule_lock:
+        former = node_states.get(uuid)
+        if former and former['state'] == state:
+            return
+        if former:
+            times = agent_stats.setdefault('time_in_state', {}).setdefault(uuid, {})
+            times[former['state']] = times.get(former['state'], 0) + now - former['since']
+        node_states[uuid] = {'state': state, 'since': now}
+
+
+# Schedule node to be driven as soon as possible
+def _wake_node(uuid):
+    global node_schedule
+    with schedule_lock:
+        node_schedule[uuid] = {'next': 0, 'delay': 0}
+
+
+# Bounded pool of threads driving nodes
+def _get_transition_pool():
+    global transition_pool, transition_workers
+    if transition_pool is None:
+        transition_pool = ThreadPool(transition_workers)
+    return transition_pool
+
+
+# Stop pools of threads once their pending calls are completed (e.g. before
+# exiting, pools are created again if needed)
+def _close_pools():
+    global fetch_pools, transition_pool
+    with clouds_lock:
+        pools = list(fetch_pools.values())
+        fetch_pools = {}
+    if transition_pool is not None:
+        pools.append(transition_pool)
+        transition_pool = None
+    for pool in pools:
+        pool.close()
+        pool.join()
+
+
+# Scheduler job: drive nodes which are due concurrently
+# (at most transition_workers nodes in flight)
+def _drive_nodes():
+    global node_schedule, nodes_in_flight, transition_workers
+    now = time.time()
+    with schedule_lock:
+        due = sorted([(sched['next'], uuid) for uuid, sched in node_schedule.items()
+                      if sched['next'] <= now and uuid not in nodes_in_flight])
+        due = [uuid for ts, uuid in due[:max(0, transition_workers - len(nodes_in_flight))]]
+        nodes_in_flight.update(due)
+        for uuid in due:
+            # Not due anymore until driven (or woken up again)
+            node_schedule[uuid]['next'] = float('inf')
+    for uuid in due:
+        _get_transition_pool().apply_async(_drive_node, (uuid,))
+
+
+# Merge provision state informations of node retrieved from Ironic: returns
+# whether node is being unregistered
+def _merge_driven_fields(uuid, machine):
+    global registered_machines
+    with persist_lock:
+        if uuid in registered_machines:
+            changes = _machine_changes(registered_machines[uuid], dict(
+                (k, machine.get(k)) for k in driven_fields))
+            if len(changes) > 0:
+                registered_machines[uuid].update(changes)
+                _machine_changed(uuid, changes)
+        _update_persisted_objects()
+        return registered_machines.get(uuid, {}).get('agent-unregistering')
+
+
+# Refresh provision state of node and request next state transition if needed
+# Nodes in transitional states are polled again quickly, stable ones with
+# exponential backoff
+def _drive_node(uuid):
+    global node_schedule, nodes_in_flight, registered_machines
+    global fast_poll_interval, max_poll_backoff
+    delay = fast_poll_interval
+    try:
+        shard = _shard_of(uuid)
+        machine = _call_cloud('get_machine', uuid, shard=shard)
+        if machine is None:
+            # Node does not exist in Ironic anymore
+            with schedule_lock:
+                node_schedule.pop(uuid, None)
+            return
+        unregistering = _write(_merge_driven_fields, uuid, machine)
+        mstate = machine.get('provision_state')
+        if unregistering:
+            # Node is torn down then deleted
+            if mstate in deletable_states:
+                _unregister_machine(uuid)
+                return
+            target = 'deleted' if mstate in teardown_states else None
+        else:
+            target = provision_transitions.get(mstate)
+        if target:
+            app.logger.info('Changing node %s from state %s to state: %s', uuid, mstate, target,
+                            extra={'uuid': uuid, 'source': mstate, 'target': target})
+            state_res = _call_cloud('node_set_provision_state', uuid, target, shard=shard)
+            _count('register_helper_transitions_total', source=mstate, target=target)
+            app.logger.debug('Changing node state %s gave %s', uuid, state_res)
+        elif mstate in stable_states:
+            delay = min(max(2 * node_schedule.get(uuid, {}).get('delay', 0), fast_poll_interval), max_poll_backoff)
+    except Exception as e:
+        app.logger.error('Got exception driving node %s: %s', uuid, e, extra={'uuid': uuid})
+        delay = min(max(2 * node_schedule.get(uuid, {}).get('delay', 0), fast_poll_interval), max_poll_backoff)
+    finally:
+        with schedule_lock:
+            nodes_in_flight.discard(uuid)
+            # Node may have been woken up or forgotten in the meantime
+            sched = node_schedule.get(uuid)
+            if sched is not None and sched['next'] == float('inf'):
+                node_schedule[uuid] = {'next': time.time() + delay, 'delay': delay}
+
+
+# Retrieve baremetal informations via shade library (all shards concurrently)
 def _get_shade_infos():
-    global registered_machines, todo_machines, shade_opts
     """Retrieve inventory utilizing Shade"""
-    app.logger.error('==================== _get_shade_infos')
+    global shards
+    if len(shards) == 1:
+        _poll_shard(next(iter(shards)))
+        return
+    threads = [threading.Thread(target=_poll_shard, args=(shard,), name='poll-' + shard) for shard in shards]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# Poll one shard (failing shards are polled again with exponential backoff)
+def _poll_shard(shard):
+    if not _shard_due(shard):
+        return
+    start = time.time()
     try:
-        cloud = shade.operator_cloud(**shade_opts)
-        machines = cloud.list_machines()
-        app.logger.error('Found {} machines'.format(len(machines)))
+        machines, all_nics = _fetch_shade_infos(shard)
+        _write(_merge_shade_infos, machines, all_nics, shard)
+        # Check once per poll if machine changes have been requested
+        _reconcile_todo_machines()
+        _write(_shard_polled, shard, start)
+    except Exception as e:
+        app.logger.error('Got exception in _get_shade_infos: %s', e, extra={'shard': shard})
+        _write(_shard_polled, shard, start, e)
+
+
+# Whether shard should be polled (not waiting for retry after failures)
+def _shard_due(shard):
+    global shard_status
+    return shard_status.get(shard, {}).get('retry-ts', 0) <= time.time()
+
+
+# Record result of a poll of shard
+def _shard_polled(shard, start, error=None):
+    global shard_status, shards, agent_stats, poll_interval, max_poll_backoff
+    now = time.time()
+    status = shard_status.setdefault(shard, {'failures': 0})
+    status['ts'] = now
+    status['duration'] = now - start
+    status['error'] = str(error) if error else None
+    if error:
+        status['failures'] += 1
+        status['retry-ts'] = now + min(poll_interval * 2 ** (status['failures'] - 1), max_poll_backoff)
+    else:
+        status['failures'] = 0
+        status['retry-ts'] = 0
+        status['success-ts'] = now
+    agent_stats['shards'] = shard_status
+    _observe('register_helper_poll_duration_seconds', now - start, result='error' if error else 'ok', shard=shard)
+    app.logger.debug('Ironic %s polled in %.3fs', shard, now - start, extra={'shard': shard})
+    if _shards_synced():
+        _inventory_synced()
+
+
+# Whether inventory is synchronized: all shards polled at least once,
+# required ones (at least one shard if none) successfully
+def _shards_synced():
+    global shard_status, shards, required_shards
+    polled = [name for name in shards if 'ts' in shard_status.get(name, {})]
+    synced = set(name for name in polled if 'success-ts' in shard_status[name])
+    required = list(shards) if '*' in required_shards else required_shards
+    return len(polled) == len(shards) and len(synced) > 0 and all(name in synced for name in required)
+
+
+# Inventory is not stale anymore once Ironic has been polled successfully
+def _inventory_synced():
+    global inventory_stale
+    if inventory_stale:
+        inventory_stale = False
+        _set_persisted_ready(True)
+
+
+# Retrieve machines and their NICs from Ironic shard (inventory is left
+# untouched)
+def _fetch_shade_infos(shard=''):
+    machines = _call_cloud('list_machines', shard=shard)
+    app.logger.info('Found %d machines', len(machines), extra={'machines': len(machines), 'shard': shard})
+    # Fetch missing details and NICs of all machines concurrently
+    details = _fetch_per_node('get_machine', [
+        m['uuid'] for m in machines if 'properties' not in m], shard)
+    machines = [m if 'properties' in m else details.get(m['uuid']) for m in machines]
+    machines = [m for m in machines if m]
+    all_nics = _fetch_per_node('list_nics_for_machine', [m['uuid'] for m in machines], shard)
+    shard_status.setdefault(shard, {'failures': 0})['machines'] = len(machines)
+    return machines, all_nics
+
+
+# Merge machines retrieved from Ironic shard into inventory, apply pending
+# registrations and persist changes (readers never see half-merged machines)
+def _merge_shade_infos(machines, all_nics, shard=''):
+    global registered_machines, todo_machines, machine_digests, node_schedule, node_shards
+    with persist_lock:
         for machine in machines:
-            app.logger.debug('Machine: {}'.format(machine))
-            if 'properties' not in machine:
-                machine = cloud.get_machine(machine['uuid'])
+            uuid = machine['uuid']
+            # Unregistered meanwhile (retrieved before deletion)
+            if uuid in unregistered_machines:
+                continue
+            node_shards[uuid] = shard
+            # Details of a sample of machines only
+            sampled = _log_sampled()
+            if sampled:
+                app.logger.debug('Machine: %s', machine, extra={'uuid': uuid})
+            if uuid not in node_schedule:
+                _wake_node(uuid)
+            if uuid not in all_nics:
+                # Keep former informations (and MAC index) until NICs can be retrieved
+                continue
+            # Unchanged Ironic informations: nothing to parse nor merge
+            digest = _machine_digest(machine, all_nics[uuid])
+            if uuid in registered_machines and machine_digests.get(uuid) == digest:
+                _machine_seen(uuid)
+                continue
 
             new_machine = {}
             if machine['name'] is None:
-                name = machine['uuid']
                 new_machine['name_from_uuid'] = True
             else:
-                name = machine['name']
                 new_machine['name_from_uuid'] = False
 
-            app.logger.debug('-----> Parsing machine infos')
-            keys = machine.keys()
-            keys.sort()
-            for key in keys:
+            for key in sorted(machine.keys()):
                 value = machine[key]
                 if key in ['extra']:
                     dict_value = {}
@@ -250,247 +1419,550 @@ def _get_shade_infos():
                 # Only keep usefull informations
                 if key not in ['links', 'ports']:
                     new_machine[key] = value
-                    app.logger.debug('Parsing key={} Value={}'.format(key, value))
+                    if sampled:
+                        app.logger.debug('Parsing key=%s Value=%s', key, value)
 
             # NOTE(TheJulia): Collect network information, enumerate through
             # and extract important values, presently MAC address. Once done,
             # return the network information to the inventory.
-            nics = cloud.list_nics_for_machine(machine['uuid'])
+            nics = all_nics[uuid]
             new_nics = []
             for nic in nics:
                 if 'address' in nic:
                     new_nics.append(nic['address'])
             new_machine['nics'] = new_nics
             new_machine['addressing_mode'] = "dhcp"
+            if shard:
+                new_machine['agent-shard'] = shard
+            # Keep MAC and name indexes in sync with discovered NICs and names
+            _index_machine_nics(uuid, registered_machines.get(uuid, {}).get('nics', []), new_nics)
+            names = _machine_names(registered_machines.get(uuid, {}))
+            machine_digests[uuid] = digest
             # Machine has just been discovered, store it
-            if not new_machine['uuid'] in registered_machines:
+            if not uuid in registered_machines:
                 new_machine['agent-stored-ts'] = time.time()
                 new_machine['agent-stored'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                app.logger.debug('-----> New machine stored: {}'.format(new_machine))
-                registered_machines[new_machine['uuid']] = new_machine
+                app.logger.info('New machine stored: %s', uuid, extra={'uuid': uuid})
+                registered_machines[uuid] = new_machine
+                _index_machine_names(uuid, names, _machine_names(new_machine))
+                _machine_changed(uuid, new_machine)
             else:
-                # Store UUID for later use
-                uuid = new_machine['uuid']
-                new_machine['agent-last-seen-ts'] = time.time()
-                new_machine['agent-last-seen'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                # Machine was previously discovered
-                app.logger.debug('-----> Merging new machine: {} {} with former data {}'.format(
-                    new_machine, '\n++++++++++\n----------\n', registered_machines[uuid]))
-                # Remove common values
-                for key, value in registered_machines[uuid].items():
-                    if key in new_machine and new_machine[key] == value:
-                        del new_machine[key]
-                # Update changed values
-                for key, value in new_machine.items():
-                    app.logger.error('Updating key {} old {} new {}'.format(
-                        key, registered_machines[uuid].get(key, ""), value))
-                    registered_machines[uuid][key] = value
-                    new_machine['agent-last-modified-ts'] = time.time()
-                    new_machine['agent-last-modified'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            # Check if machine changes have been requested
-            modified = []
-            for key, value in todo_machines.items():
-                app.logger.error('Machine vid {} needs to be updated with {}'.format(
-                    key, pprint.pformat(value)))
-                rkey = _find_machine(value.get('mac_addr', None))
-                # Machine with same MAC address has been found
-                if rkey:
-                    # Patch was successfull
-                    if _patch_machine(rkey, key, value):
-                        modified.append(key)
-            # Remove patched machines
-            for key in modified:
-                del todo_machines[key]
+                # Machine was previously discovered: only keep changed values
+                changes = _machine_changes(registered_machines[uuid], new_machine)
+                _machine_seen(uuid)
+                if len(changes) > 0:
+                    changes['agent-last-modified-ts'] = time.time()
+                    changes['agent-last-modified'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    registered_machines[uuid].update(changes)
+                    _index_machine_names(uuid, names, _machine_names(registered_machines[uuid]))
+                    _machine_changed(uuid, changes)
+        # Deleted machines are not retrieved anymore
+        retrieved = set(m['uuid'] for m in machines)
+        for uuid in [u for u, s in unregistered_machines.items() if s == shard and u not in retrieved]:
+            del unregistered_machines[uuid]
+
+    # Update objects to be persisted
+    _update_persisted_objects()
+
+
+# Try to become the worker polling Ironic (lock is released by the system
+# when worker exits)
+def _try_lead():
+    global poll_lock_file, poll_lock_fd, poll_leader
+    if poll_leader:
+        return True
+    if HAS_FCNTL and poll_lock_file is not None:
+        if poll_lock_fd is None:
+            poll_lock_fd = os.open(poll_lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(poll_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return False
+    poll_leader = True
+    app.logger.info('Worker %d polls Ironic', os.getpid())
+    return True
+
+
+# Schedule polls of Ironic and nodes driver (polling worker only)
+def _start_polling():
+    global poll_jobs, driver_job, shards
+    # Independent schedule for each shard
+    poll_jobs = [scheduler.add_job(_poll_shard, 'interval', args=[shard], seconds=poll_interval)
+                 for shard in shards]
+    driver_job = scheduler.add_job(_drive_nodes, 'interval', seconds=driver_interval)
 
-        for uuid, machine in registered_machines.items():
-            app.logger.error('Checking machine uuid {}  => {}'.format(uuid, pprint.pformat(machine)))
-            mstate = machine.get('provision_state', None)
-            app.logger.error('Checking for state: {}'.format(mstate))
-            try:
-                if mstate == 'enroll':
-                    app.logger.error('Changing to state: {}'.format('manage'))
-                    state_res = cloud.node_set_provision_state(uuid, 'manage')
-                    app.logger.error('Changing node state {} gave {}'.format(uuid, pprint.pformat(state_res)))
-                elif mstate == 'manageable':
-                    app.logger.error('Changing to state: {}'.format('provide'))
-                    state_res = cloud.node_set_provision_state(uuid, 'provide')
-                    app.logger.error('Changing node state {} gave {}'.format(uuid, pprint.pformat(state_res)))
-                elif mstate == 'available':
-                    app.logger.error('Changing to state: {}'.format('active'))
-                    state_res = cloud.node_set_provision_state(uuid, 'active')
-                    app.logger.error('Changing node state {} gave {}'.format(uuid, pprint.pformat(state_res)))
-            except Exception as e:
-                app.logger.error('Got exception changing node to state {}: {}'.format(mstate, e))
-
-        # Update objects to be persisted
-        _update_persisted_objects()
 
+# Load changes made by other workers: returns whether inventory changed
+def _load_shared_changes():
+    global persist_db, store_commits, inventory_stale
+    with persist_lock:
+        if inventory_stale and not poll_leader:
+            # Polling worker has synchronized shared state with Ironic
+            inventory_stale = persist_db.execute("SELECT value FROM meta WHERE name = 'ready'").fetchone()[0] == 0
+        if _persisted_counters()[0] == store_commits:
+            return False
+        return _load_persisted_objects()
+
+
+# Load changes made by other workers (and replace polling worker if it exited)
+def _sync_shared_store():
+    global persist_db, store_commits, inventory_stale
+    if not poll_leader and _try_lead():
+        _get_shade_infos()
+        # asyncio serving mode runs its own polls
+        if scheduler.running:
+            _start_polling()
+    if persist_db is None:
+        return
+    if not _write(_load_shared_changes):
+        return
+    # Wake up watchers
+    with inventory_cond:
+        inventory_cond.notify_all()
+    for listener in inventory_listeners:
+        listener()
+
+
+# Restore state from persistence store or JSON bootstrapping file
+# (Ironic is not called: bootstrap data is merged by warm-up)
+def _restore_state():
+    global persist_db, first_call_to_shade, bootstrap_data
+    try:
+        # Only one worker polls Ironic, migrates or bootstraps state, others
+        # share its persisted state
+        if not _try_lead():
+            first_call_to_shade = False
+        has_persist = os.path.isfile(persist_file) or not poll_leader
+        persist_db = _open_persisted_objects(persist_file)
+        if poll_leader:
+            # Persisted state is stale until Ironic is polled
+            _set_persisted_ready(False)
+            _purge_persisted_objects()
+        # Migrate former shelve backup into persistence store
+        if not has_persist and os.path.isfile(shelve_file):
+            app.logger.info('Migrating saved state from: %s', shelve_file)
+            shelve_db = shelve.open(shelve_file, flag='r')
+            for kind in ['registered', 'todo']:
+                for key, value in shelve_db.get(kind + '_machines', {}).items():
+                    _persisted_dict(kind)[key] = value
+                    _mark_dirty(kind, key)
+            shelve_db.close()
+            _update_persisted_objects()
+            os.rename(shelve_file, shelve_file + time.strftime("_%Y-%m-%d-%H-%M-%S.bak"))
+            has_persist = True
+        # Retrieve saved records if they exist in persistence store
+        if has_persist:
+            # Check proper access (but may be this should have failed in the sqlite3.connect call above)
+            if not os.access(persist_file, os.R_OK):
+                app.logger.error('Can not read saved state from: %s', persist_file)
+            else:
+                app.logger.info('Restoring saved state from: %s', persist_file)
+                # Restore persited objects into current memory
+                _load_persisted_objects()
+                _rebuild_indexes()
+        else:
+            # No saved state but may be a JSON bootstrapping status file can be found
+            has_bootstrap = os.path.isfile(bootstrap_file)
+            if has_bootstrap:
+                if not os.access(bootstrap_file, os.R_OK):
+                    app.logger.error('Can not read bootstrap state from: %s', bootstrap_file)
+                else:
+                    app.logger.info('Restoring bootstrap state from: %s', bootstrap_file)
+                    # Load JSON informations into bootstrap data
+                    with open(bootstrap_file) as bootstrap_fd:
+                        bootstrap_data = json.load(bootstrap_fd)
+                        bak_extension = time.strftime("_%Y-%m-%d-%H-%M-%S.bak")
+                        # Moving file so it does not get reparsed on next restart
+                        os.rename(bootstrap_file, os.path.splitext(bootstrap_file)[0] + bak_extension)
+                    if app.logger.isEnabledFor(logging.DEBUG):
+                        app.logger.debug('Restored bootstrap data: %s', pprint.pformat(bootstrap_data))
+        # Whole inventory only formatted if it is logged
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug('Restored registered_machines: %s', pprint.pformat(registered_machines))
+            app.logger.debug('Restored todo_machines: %s', pprint.pformat(todo_machines))
     except Exception as e:
-        app.logger.error('Got exception in _get_shade_infos: {}'.format(e))
+        app.logger.error('Got exception while restoring state: %s', e)
 
 
-# Try to restore state from shelve backup or JSON bootstrapping file
-try:
-    # Retrieve base directory of Python script
-    script_base_dir = os.path.dirname(os.path.realpath(__file__))
-    script_filename = os.path.basename(__file__)
-    # Shelve file will be stored in same directory with the prefix of Python
-    # script name (without .py extension) with additional .db extension
-    shelve_file = os.path.join(script_base_dir, os.path.splitext(script_filename)[0] + ".db")
-    has_shelve = os.path.isfile(shelve_file)
-    shelve_db = shelve.open(shelve_file, writeback=True)
-    # Retrieve saved variables if they exist in shelve store
-    if has_shelve:
-        # Check proper access (but may be this should have failed in the shelve.open call above)
-        if not os.access(shelve_file, os.R_OK):
-            app.logger.error('Can not read saved state from: {}'.format(shelve_file))
+# JSON bootstrap data needs to be merged into Ironic structures
+def _merge_bootstrap_data(data):
+    for k, v in data.items():
+        machine_uuid = v.get('ironic-uuid')
+        # We can not do much without ironic-uuid information
+        if not machine_uuid:
+            app.logger.error('Can not process machine %s: (missing ironic-uuid) %s', k, v)
         else:
-            app.logger.error('Restoring saved state from: {}'.format(shelve_file))
-            # Restore persited objects into current memory
-            registered_machines = shelve_db.get('registered_machines', {})
-            todo_machines = shelve_db.get('todo_machines', {})
-            # Empty list of machines, call shade to get update from Ironic current state
-            if len(registered_machines.keys()) == 0 and first_call_to_shade:
-                _get_shade_infos()
-                first_call_to_shade = False
-    else:
-        # No shelve backup but may be a JSON bootstrapping status file can be found
-        bootstrap_file = os.path.join(script_base_dir, os.path.splitext(script_filename)[0] + ".json")
-        has_bootstrap = os.path.isfile(bootstrap_file)
-        if has_bootstrap:
-            if not os.access(bootstrap_file, os.R_OK):
-                app.logger.error('Can not read bootstrap state from: {}'.format(bootstrap_file))
+            # Get the Ironic informations corresponding to current UUID
+            shade_machine = registered_machines.get(machine_uuid)
+            if not shade_machine:
+                app.logger.error('Can not retrieve machine %s UUID %s', k, machine_uuid)
             else:
-                app.logger.error('Restoring bootstrap state from: {}'.format(bootstrap_file))
-                data = {}
-                # Load JSON informations into local data object
-                with open(bootstrap_file) as bootstrap_fd:
-                    data = json.load(bootstrap_fd)
-                    bak_extension = time.strftime("_%Y-%m-%d-%H-%M-%S.bak")
-                    # Moving file so it does not get reparsed on next restart
-                    os.rename(bootstrap_file, os.path.splitext(bootstrap_file)[0] + bak_extension)
-                app.logger.debug('Restored bootstrap data: {}'.format(pprint.pformat(data)))
-                # 1st call performed right away at start call shade to get update from Ironic current state
-                if first_call_to_shade:
-                    _get_shade_infos()
-                    first_call_to_shade = False
-                    # JSON needs to be merged into Ironic structures
-                    if len(data.keys()) != 0:
-                        for k, v in data.items():
-                            machine_uuid = v.get('ironic-uuid')
-                            # We can not do much without ironic-uuid information
-                            if not machine_uuid:
-                                app.logger.error('Can not process machine {}: (missing ironic-uuid) {}'.format(k, pprint.pformat(v)))
-                            else:
-                                # Get the Ironic informations corresponding to current UUID
-                                shade_machine = registered_machines.get(machine_uuid)
-                                if not shade_machine:
-                                    app.logger.error('Can not retrieve machine {} UUID {}'.format(k, machine_uuid))
-                                else:
-                                    # Restore defaults attributes
-                                    m_changes = {'name': k, 'virt-uuid': v.get('virt-uuid')}
-                                    vnc_infos = v.get('vnc-info', '').split(':')
-                                    # If VNC information is retrieved it need to be re-splitted for proper processing
-                                    if len(vnc_infos) == 2:
-                                        m_changes['vnc_host'] = vnc_infos[0]
-                                        m_changes['vnc_port'] = vnc_infos[1]
-                                    roles = v.get('extra/roles')
-                                    if roles:
-                                        m_changes['roles'] = roles
-                                    tags = v.get('extra/tags')
-                                    if tags:
-                                        m_changes['tags'] = tags
-                                    app.logger.debug('Updating bootstrap registered_machines: {}'.format(pprint.pformat(m_changes)))
-                                    # Call same procedure than when machine is 1st registered into register-helper utility
-                                    _patch_machine(machine_uuid, v.get('virt-uuid'), m_changes)
-                                    app.logger.debug('Restored bootstrap registered_machines: {}'.format(pprint.pformat(shade_machine)))
-    app.logger.debug('Restored registered_machines: {}'.format(pprint.pformat(registered_machines)))
-    app.logger.debug('Restored todo_machines: {}'.format(pprint.pformat(todo_machines)))
-except Exception as e:
-    app.logger.error('Got exception while restoring state: {}'.format(e))
-
-# 1st call performed right away at start call shade to get update from Ironic current state
-if first_call_to_shade:
-    _get_shade_infos()
-    first_call_to_shade = False
-
-# Update objects to be persisted
-_update_persisted_objects()
-
-# Define and  start asynchronous scheduler after
-# registering job
-scheduler = BackgroundScheduler()
-job = scheduler.add_job(_get_shade_infos, 'interval', seconds=30)
-scheduler.start()
+                # Restore defaults attributes
+                m_changes = {'name': k, 'virt-uuid': v.get('virt-uuid')}
+                vnc_infos = v.get('vnc-info', '').split(':')
+                # If VNC information is retrieved it need to be re-splitted for proper processing
+                if len(vnc_infos) == 2:
+                    m_changes['vnc_host'] = vnc_infos[0]
+                    m_changes['vnc_port'] = vnc_infos[1]
+                roles = v.get('extra/roles')
+                if roles:
+                    m_changes['roles'] = roles
+                tags = v.get('extra/tags')
+                if tags:
+                    m_changes['tags'] = tags
+                app.logger.debug('Updating bootstrap registered_machines: %s', m_changes)
+                # Call same procedure than when machine is 1st registered into register-helper utility
+                _patch_machine(machine_uuid, v.get('virt-uuid'), m_changes)
+                app.logger.debug('Restored bootstrap registered_machines: %s', shade_machine)
+
+
+# Warm-up: 1st synchronization with Ironic current state (polling worker
+# only) performed in background, persisted state being served meanwhile
+def _warm_up():
+    global first_call_to_shade, bootstrap_data, agent_stats
+    start = time.time()
+    if first_call_to_shade:
+        _get_shade_infos()
+        first_call_to_shade = False
+        if len(bootstrap_data.keys()) != 0:
+            _write(_merge_bootstrap_data, bootstrap_data)
+            bootstrap_data = {}
+    # Update objects to be persisted
+    _write(_update_persisted_objects)
+    agent_stats['warm_up'] = {'duration': time.time() - start, 'ts': time.time()}
+    app.logger.info('Warm-up done in %.3fs', time.time() - start, extra={'duration': time.time() - start})
+    if poll_leader and scheduler.running:
+        _start_polling()
+
+
+# Application factory: persisted state is restored and served right away
+# (marked stale), warm-up and periodic jobs are started in background
+def create_app():
+    global app_started, store_job, warm_up_thread
+    with app_started_lock:
+        if not app_started:
+            app_started = True
+            _restore_state()
+            store_job = scheduler.add_job(_sync_shared_store, 'interval', seconds=store_refresh_interval)
+            scheduler.start()
+            warm_up_thread = threading.Thread(target=_warm_up, name='warm-up')
+            warm_up_thread.daemon = True
+            warm_up_thread.start()
+    return app
+
+
+# Fields of machines reported by /status: (name, path in machine record)
+status_fields = [(f, tuple(f.split('/'))) for f in [
+    'vnc-info', 'virt-uuid', 'power_state', 'target_power_state',
+    'provision_state', 'last_error', 'properties/cpus',
+    'properties/local_gb', 'properties/memory_mb', 'target_provision_state',
+    'extra/roles', 'extra/tags', 'extra/all/macs', 'extra/all/interfaces/eth0/ip',
+    'agent-created', 'agent-last-seen', 'agent-last-modified', 'agent-shard',
+]]
+
+
+# Resolve slash-separated path (e.g. extra/all/interfaces/eth0/ip) in record
+def _get_path(record, path):
+    value = record
+    for key in path:
+        value = value.get(key)
+        if not value:
+            break
+    return value
+
+
+# Keep only requested fields of record (fields may be slash-separated paths)
+# Records are copied (values of fields are replaced, never changed, when
+# records are updated) so that views can be serialized while inventory
+# changes
+def _project(record, fields):
+    if not fields:
+        return dict(record)
+    ret = {}
+    for f, path in fields:
+        value = record[f] if f in record else _get_path(record, path)
+        if value:
+            ret[f] = value
+    return ret
+
+
+# Index of registered machines by provision state, role, tag and shard
+# (rebuilt once per inventory revision)
+def _get_inventory_index():
+    global inventory_index
+    if inventory_index['revision'] != inventory_revision:
+        index = {'revision': inventory_revision, 'state': {}, 'role': {}, 'tag': {}, 'shard': {}}
+        for uuid, machine in registered_machines.items():
+            index['state'].setdefault(machine.get('provision_state'), set()).add(uuid)
+            index['shard'].setdefault(machine.get('agent-shard', ''), set()).add(uuid)
+            for role in _get_path(machine, ('extra', 'roles')) or []:
+                index['role'].setdefault(role, set()).add(uuid)
+            for tag in _get_path(machine, ('extra', 'tags')) or []:
+                index['tag'].setdefault(tag, set()).add(uuid)
+        inventory_index = index
+    return inventory_index
+
+
+# UUIDs of registered machines matching state, role, tag and shard filters
+def _select_machines(filters):
+    uuids = None
+    index = _get_inventory_index()
+    for kind in ['state', 'role', 'tag', 'shard']:
+        if kind in filters:
+            selected = set()
+            for value in filters[kind]:
+                selected |= index[kind].get(value, set())
+            uuids = selected if uuids is None else uuids & selected
+    return registered_machines.keys() if uuids is None else uuids
+
+
+# Registered machines matching filters: list of (name, uuid, machine)
+# Machines of several shards sharing the same name are named <shard>/<name>
+# instead of replacing each other in views (names reported in /stats)
+def _filter_machines(filters):
+    global agent_stats
+    ret = []
+    for k in _select_machines(filters):
+        v = registered_machines[k]
+        vname = v.get('kvm-name')
+        if not vname:
+            continue
+        if 'name' in filters and not filters['name'].match(vname):
+            continue
+        ret.append((vname, k, v))
+    counts = collections.Counter(vname for vname, k, v in ret)
+    collisions = set(vname for vname, count in counts.items() if count > 1)
+    if len(filters) == 0:
+        agent_stats['name_collisions'] = sorted(collisions)
+    if len(collisions) > 0:
+        ret = [('{}/{}'.format(v.get('agent-shard', ''), vname) if vname in collisions else vname, k, v)
+               for vname, k, v in ret]
+    return ret
+
+
+# Full dump of agent infos
+def _build_dump_view(filters):
+    if len(filters) == 0:
+        return {
+            'todo': dict((k, dict(v)) for k, v in todo_machines.items()),
+            'registered': dict((k, dict(v)) for k, v in registered_machines.items()),
+        }
+    todo = {}
+    if len(set(['state', 'role', 'tag', 'shard']) & set(filters.keys())) == 0:
+        for k, v in todo_machines.items():
+            if 'name' not in filters or filters['name'].match(v.get('name') or ''):
+                todo[k] = _project(v, filters.get('fields'))
+    return {
+        'todo': todo,
+        'registered': dict((k, _project(v, filters.get('fields'))) for vname, k, v in _filter_machines(filters)),
+    }
+
+
+# Machines registered but not handled yet by Ironic
+def _build_waiting_view(filters):
+    return dict((k, dict(v)) for k, v in todo_machines.items())
+
+
+# Already registered machines
+def _build_machines_view(filters):
+    # Copy dictionnary
+    ret = {}
+    for vname, k, v in _filter_machines(filters):
+        ret[vname] = _project(v, filters.get('fields'))
+    return ret
+
+
+# Current status of machines
+def _build_status_view(filters):
+    ret = {}
+    for vname, k, v in _filter_machines(filters):
+        ret[vname] = {'ironic-uuid': k}
+        for f, path in status_fields:
+            v1 = _get_path(v, path)
+            if v1:
+                ret[vname][f] = v1
+        ret[vname] = _project(ret[vname], filters.get('fields'))
+    return ret
+
+
+# Filters of views from query parameters:
+# - name: regular expression matched against machine names
+# - state, role, tag, shard: provision states, roles, tags or Ironic
+#   endpoints (any of them)
+# - fields: fields (or slash-separated paths) to be returned
+# Parameters can be repeated or contain comma separated values
+def _view_filters():
+    filters = {}
+    for kind in ['state', 'role', 'tag', 'shard', 'fields']:
+        values = [v for arg in request.args.getlist(kind) for v in arg.split(',') if v]
+        if len(values) > 0:
+            filters[kind] = sorted(set(values))
+    if 'fields' in filters:
+        filters['fields'] = [(f, tuple(f.split('/'))) for f in filters['fields']]
+    if request.args.get('name'):
+        try:
+            filters['name'] = re.compile(request.args['name'])
+        except re.error as e:
+            abort(400, 'Invalid name regular expression: {}'.format(e))
+    return filters
+
+
+# Get view serialized as JSON for current inventory revision
+# (views are only rebuilt once after each inventory change): records are
+# copied while holding persist_lock and serialized outside of it, other
+# views are built meanwhile
+def _get_view(name, builder):
+    global views, views_lock, view_locks, max_views
+    with views_lock:
+        lock = view_locks.setdefault(name, threading.Lock())
+    with lock:
+        view = views.get(name)
+        if view is None or view['revision'] != inventory_revision:
+            with persist_lock:
+                revision = inventory_revision
+                content = builder()
+            body = json.dumps(content, sort_keys=True, default=str).encode('utf-8')
+            etag = hashlib.sha1(body).hexdigest()
+            view = {
+                'revision': revision,
+                # Revision at which view content last changed
+                'changed': view['changed'] if view and view['etag'] == etag else revision,
+                'body': body,
+                'etag': etag,
+            }
+        with views_lock:
+            # Most recently used views are kept at the end
+            views.pop(name, None)
+            views[name] = view
+            while len(views) > max_views:
+                evicted, _ = views.popitem(last=False)
+                view_locks.pop(evicted, None)
+        return view
+
+
+# View already serialized for current inventory revision (None otherwise)
+# Never waits for locks held while inventory changes or views are built
+def _cached_view(name):
+    view = views.get(name)
+    if view is not None and view['revision'] == inventory_revision:
+        return view
+    return None
+
+
+# Cache key and builder of view requested (filters from query parameters)
+def _view_request(name, builder):
+    filters = _view_filters()
+    if len(filters) > 0:
+        # Filtered views are cached by canonical query
+        name += '?' + '&'.join('{}={}'.format(k, ','.join(f[0] for f in v) if k == 'fields' else
+                                              v.pattern if k == 'name' else ','.join(v))
+                               for k, v in sorted(filters.items()))
+    return name, lambda: builder(filters)
+
+
+# Wait until view content changes after given revision (or timeout)
+def _wait_view(name, builder, since, wait):
+    deadline = time.time() + wait
+    while True:
+        view = _get_view(name, builder)
+        remaining = deadline - time.time()
+        if view['changed'] > since or remaining <= 0:
+            return view
+        with inventory_cond:
+            # Only sleep if no change occurred since view was retrieved
+            if view['revision'] == inventory_revision:
+                inventory_cond.wait(remaining)
+
+
+# Reply with view or with 304 Not Modified if client already has it
+# Watch requests (wait=<seconds> and optional since=<revision> query
+# parameters, the revision defaulting to current one) are only answered
+# once view content changes after given revision or after waiting
+def _view_response(name, builder):
+    name, view_builder = _view_request(name, builder)
+    wait = min(request.args.get('wait', 0, type=float), max_wait)
+    if wait > 0:
+        view = _wait_view(name, view_builder, request.args.get('since', inventory_revision, type=int), wait)
+    else:
+        view = _get_view(name, view_builder)
+    if request.if_none_match.contains(view['etag']):
+        resp = Response(status=304)
+    else:
+        resp = Response(view['body'], mimetype='application/json')
+    resp.set_etag(view['etag'])
+    resp.headers['X-Inventory-Revision'] = str(view['revision'])
+    # Persisted inventory served before Ironic has been polled
+    resp.headers['X-Inventory-Stale'] = 'true' if inventory_stale else 'false'
+    return resp
 
 
 # GET full dump of agent infos
 @app.route('/dump')
 @requires_auth
 def get_dump():
-    return jsonify({
-        'todo': todo_machines,
-        'registered': registered_machines,
-    })
+    return _view_response('dump', _build_dump_view)
+
+
+# GET request handler to retrieve internal counters of the agent
+@app.route('/stats')
+@requires_auth
+def get_stats():
+    with schedule_lock:
+        agent_stats['node_states'] = dict((uuid, dict(state, age=time.time() - state['since']))
+                                          for uuid, state in node_states.items())
+        return jsonify(dict(agent_stats, stale=inventory_stale, leader=poll_leader))
+
+
+# GET request handler for health checks (no authentication): ready once
+# inventory has been synchronized with Ironic, persisted inventory being
+# served meanwhile (marked stale)
+@app.route('/healthz')
+def get_healthz():
+    health = {
+        'ready': not inventory_stale,
+        'stale': inventory_stale,
+        'leader': poll_leader,
+        'revision': inventory_revision,
+    }
+    if len(shards) > 1:
+        # Polls of each Ironic endpoint (polling worker only)
+        health['shards'] = dict((name, {'synced': 'success-ts' in shard_status.get(name, {}),
+                                        'error': shard_status.get(name, {}).get('error'),
+                                        'failures': shard_status.get(name, {}).get('failures', 0)})
+                                for name in shards)
+    return jsonify(health), 200 if not inventory_stale else 503
 
 
 # GET request handler to list machines registered but not handled yet by Ironic
 @app.route('/waiting')
 @requires_auth
 def get_waiting():
-    return jsonify(todo_machines)
+    return _view_response('waiting', _build_waiting_view)
 
 
 # GET request handler to list already registered machines
 @app.route('/machines')
 @requires_auth
 def get_machines():
-    # Copy dictionnary
-    ret = {}
-    for k, v in registered_machines.items():
-        vname = v.get('kvm-name')
-        if not vname:
-            continue
-        ret[vname] = v
-    return jsonify(ret)
+    return _view_response('machines', _build_machines_view)
 
 
 # GET request handler to get current status of machines
 @app.route('/status')
 @requires_auth
 def get_status():
-    ret = {}
-    for k, v in registered_machines.items():
-        vname = v.get('kvm-name')
-        if not vname:
-            continue
-        ret[vname] = {'ironic-uuid': k}
-        for f in ['vnc-info', 'virt-uuid', 'power_state', 'target_power_state',
-                  'provision_state', 'last_error', 'properties/cpus',
-                  'properties/local_gb', 'properties/memory_mb', 'target_provision_state',
-                  'extra/roles', 'extra/tags', 'extra/all/macs', 'extra/all/interfaces/eth0/ip',
-                  'agent-created', 'agent-last-seen', 'agent-last-modified',
-                  ]:
-            if '/' not in f:
-                v1 = v.get(f)
-            else:
-                v1 = None
-                v2 = v
-                for f1 in f.split('/'):
-                    v2 = v2.get(f1)
-                    if not v2:
-                        break
-#                    if f1 == 'all':
-#                        try:
-#                            v2 = ast.literal_eval(v2)
-#                        except Exception as e:
-#                            v2 = None
-#                            break
-                if v2:
-                    v1 = v2
-            if v1:
-                ret[vname][f] = v1
-    return jsonify(ret)
+    return _view_response('status', _build_status_view)
+
+
+# Store pending registrations (virt-uuid -> registration) in a single
+# transaction
+def _add_registrations(records):
+    global todo_machines
+    with persist_lock:
+        for vid, record in records.items():
+            todo_machines[vid] = record
+            _mark_dirty('todo', vid)
+        _update_persisted_objects()
 
 
 # POST request handler to register new machines
@@ -498,42 +1970,321 @@ def get_status():
 @requires_auth
 def add_machine():
     global todo_machines
-    app.logger.error("Request headers: {}".format(pprint.pformat(request.headers)))
-    app.logger.error("Request data: {}".format(pprint.pformat(request.get_data())))
-    mime_header = request.headers.get('Content-Type', "dummy/dummy").split('/')
-    # return '', 301
-    newm = request.get_json()
-    app.logger.error("adding machine: {}".format(newm))
-    todo_machines[newm['virt-uuid']] = newm
-    # Update objects to be persisted
-    _update_persisted_objects()
+    newm = request.get_json(silent=True)
+    error = _check_registration(newm)
+    if error is not None:
+        return jsonify(error=error), 400
+    app.logger.info("adding machine: %s", newm['virt-uuid'], extra={'vid': newm['virt-uuid']})
+    _write(_add_registrations, {newm['virt-uuid']: newm})
     return '', 201
 
 
-# PUT request handler to modify machines
-@app.route('/update/<machineid>', methods=['PUT'])
+# Iterate over elements of a JSON array read by chunks from stream
+# (only the element being decoded is kept in memory)
+def _iter_json_array(stream):
+    global bulk_chunk_size
+    decoder = json.JSONDecoder()
+    reader = codecs.getreader('utf-8')(stream)
+    buf, pos, eof = u'', 0, False
+    # Next expected token: '[', first value (or ']'), value or separator
+    expected = '['
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise ValueError('Truncated JSON array')
+            buf, pos = reader.read(bulk_chunk_size), 0
+            eof = len(buf) == 0
+            continue
+        if expected == '[':
+            if buf[pos] != '[':
+                raise ValueError('JSON array expected')
+            pos, expected = pos + 1, 'first'
+        elif expected == 'value' or (expected == 'first' and buf[pos] != ']'):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            if end is None or (end == len(buf) and not eof):
+                # Value possibly incomplete: read more data
+                chunk = reader.read(bulk_chunk_size)
+                eof = len(chunk) == 0
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            yield value
+            pos, expected = end, 'separator'
+        elif buf[pos] == ']':
+            return
+        elif expected == 'separator' and buf[pos] == ',':
+            pos, expected = pos + 1, 'value'
+        else:
+            raise ValueError('Unexpected character {!r} in JSON array'.format(buf[pos]))
+
+
+# Iterate over rows of a CSV document read from stream, the first row holding
+# field names (empty cells are ignored, JSON lists or mappings are decoded)
+def _iter_csv_records(stream):
+    if sys.version_info[0] >= 3:
+        stream = codecs.getreader('utf-8')(stream)
+    for row in csv.DictReader(stream):
+        record = {}
+        for k, v in row.items():
+            if isinstance(v, list):
+                # Cells in excess
+                record[k] = v
+                continue
+            v = (v or '').strip()
+            if len(v) == 0:
+                continue
+            if v[0] in '[{':
+                try:
+                    v = json.loads(v)
+                except ValueError:
+                    pass
+            record[k] = v
+        yield record
+
+
+# Iterate over records of a (multi-documents) YAML stream, documents being
+# either a single record or a list of records
+# (scalars are kept as strings: unquoted MAC addresses would be read as
+# sexagesimal integers otherwise)
+def _iter_yaml_records(stream):
+    for doc in yaml.load_all(stream, Loader=yaml.BaseLoader):
+        if isinstance(doc, list):
+            for record in doc:
+                yield record
+        elif doc is not None:
+            yield doc
+
+
+# Check record of a machine to be registered
+# Returns error message or None if record is valid
+def _check_registration(record):
+    global mac_regex, string_types
+    if not isinstance(record, dict):
+        return 'Record is not a mapping'
+    if None in record:
+        return 'Unexpected cells: {}'.format(record[None])
+    if not isinstance(record.get('virt-uuid'), string_types) or len(record['virt-uuid']) == 0:
+        return 'Missing or invalid virt-uuid'
+    mac_addr = record.get('mac_addr')
+    if not isinstance(mac_addr, string_types) or not mac_regex.match(_normalize_mac(mac_addr) or ''):
+        return 'Missing or invalid mac_addr'
+    if not isinstance(record.get('roles', []), list):
+        return 'Invalid roles'
+    if not isinstance(record.get('tags', []), (list, dict)):
+        return 'Invalid tags'
+    return None
+
+
+# POST request handler to register machines in bulk
+# Body is a JSON array, a CSV document or a (multi-documents) YAML stream
+# of registrations, parsed while being received. Valid registrations are
+# persisted at once and per-record results are returned
+@app.route('/register/bulk', methods=['POST'])
+@requires_auth
+def add_machines():
+    global todo_machines
+    parse_errors = (ValueError, csv.Error)
+    mimetype = request.mimetype
+    if mimetype.endswith('json'):
+        records = _iter_json_array(request.stream)
+    elif mimetype.endswith('csv'):
+        records = _iter_csv_records(request.stream)
+    elif mimetype.endswith('yaml') and HAS_YAML:
+        records = _iter_yaml_records(request.stream)
+        parse_errors += (yaml.YAMLError,)
+    else:
+        return jsonify(error='Unsupported content type {}'.format(mimetype)), 415
+    results = []
+    accepted = collections.OrderedDict()
+    try:
+        for idx, record in enumerate(records):
+            error = _check_registration(record)
+            vid = record.get('virt-uuid') if isinstance(record, dict) else None
+            if error is None and vid in accepted:
+                error = 'Duplicate virt-uuid'
+            if error is None:
+                accepted[vid] = record
+            results.append({'index': idx, 'virt-uuid': vid,
+                            'status': 'rejected' if error else 'registered', 'error': error})
+    except parse_errors as e:
+        # Nothing registered on malformed body
+        app.logger.error('bulk registration parse error after %d records: %s', len(results), e)
+        return jsonify(error='Invalid {} body: {}'.format(mimetype, e), index=len(results)), 400
+    app.logger.info('adding %d machines (%d rejected)', len(accepted), len(results) - len(accepted))
+    _write(_add_registrations, accepted)
+    return jsonify(results), 201 if len(accepted) == len(results) else 207
+
+
+# Apply changes requested for a machine to the inventory: returns HTTP
+# status and error of request, with (Ironic UUID, virt-uuid, Ironic patch)
+# for registered machines (None otherwise)
+def _update_machine_record(machineid, changes):
+    global registered_machines, todo_machines
+    with persist_lock:
+        kind, key = _resolve_machine(machineid)
+        if kind is None:
+            return 404, 'Unknown machine {}'.format(machineid), None
+        if kind == 'todo':
+            vid = changes.get('virt-uuid', key)
+            record = dict(todo_machines[key], **changes)
+            error = _check_registration(record)
+            if error is not None:
+                return 400, error, None
+            del todo_machines[key]
+            todo_machines[vid] = record
+            _mark_dirty('todo', key)
+            _mark_dirty('todo', vid)
+            _update_persisted_objects()
+            return 204, None, None
+        vid = changes.get('virt-uuid', registered_machines[key].get('virt-uuid'))
+        patch = _build_machine_patch(key, vid, changes)
+        _update_persisted_objects()
+        return 204, None, (key, vid, patch)
+
+
+# Keep changes of a registered machine whose Ironic patch failed as a
+# pending registration (retried on next polls)
+def _keep_failed_update(uuid, vid, changes):
+    global registered_machines, todo_machines
+    with persist_lock:
+        nics = registered_machines.get(uuid, {}).get('nics', [])
+        if len(nics) > 0:
+            vid = vid or uuid
+            todo_machines[vid] = dict(changes, **{'virt-uuid': vid, 'mac_addr': nics[0]})
+            _mark_dirty('todo', vid)
+            _update_persisted_objects()
+
+
+# PUT request handler to modify machines designated by Ironic UUID, name
+# (optionally qualified by shard: <shard>/<name>), virt-uuid or MAC address
+# (same fields as registrations)
+# Registered machines are patched in Ironic right away: if this fails,
+# changes are kept as a pending registration retried on next polls
+@app.route('/update/<path:machineid>', methods=['PUT'])
 @requires_auth
 def update_machine(machineid):
-    app.logger.debug("updating machine: {}".format(machineid))
+    global registered_machines, todo_machines
+    app.logger.debug("updating machine: %s", machineid)
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict):
+        return jsonify(error='JSON object expected'), 400
+    status, error, pending = _write(_update_machine_record, machineid, changes)
+    if error is not None:
+        return jsonify(error=error), status
+    if pending is None:
+        return '', status
+    key, vid, patch = pending
+    try:
+        _apply_machine_patch(key, patch)
+    except Exception as e:
+        app.logger.error('Got exception patching machine %s: %s', key, e, extra={'uuid': key})
+        _write(_keep_failed_update, key, vid, changes)
+        return jsonify(error='Ironic patch failed (retried on next poll): {}'.format(e)), 202
     return '', 204
 
 
-# DELETE request handler to unregister machines
-@app.route('/unregister/<machineid>', methods=['DELETE'])
+# Drop pending registration of a machine (also for registered ones):
+# returns kind of record, its key and provision state (registered machines)
+def _delete_machine_record(machineid):
+    global registered_machines, todo_machines
+    with persist_lock:
+        kind, key = _resolve_machine(machineid)
+        if kind is None:
+            return None, None, None
+        vid = key if kind == 'todo' else registered_machines[key].get('virt-uuid')
+        if vid in todo_machines:
+            del todo_machines[vid]
+            _mark_dirty('todo', vid)
+        _update_persisted_objects()
+        return kind, key, registered_machines[key].get('provision_state') if kind == 'registered' else None
+
+
+# Registered machine is torn down then deleted by the nodes driver
+def _mark_unregistering(uuid):
+    global registered_machines
+    with persist_lock:
+        if uuid in registered_machines:
+            registered_machines[uuid]['agent-unregistering'] = time.time()
+            _mark_dirty('registered', uuid)
+            _update_persisted_objects()
+
+
+# DELETE request handler to unregister machines designated by Ironic UUID,
+# name (optionally qualified by shard), virt-uuid or MAC address
+# Pending registrations are dropped, registered machines are deleted from
+# Ironic right away if their state allows it, otherwise (e.g. active ones)
+# they are torn down first by the nodes driver
+@app.route('/unregister/<path:machineid>', methods=['DELETE'])
 @requires_auth
 def delete_machine(machineid):
-    app.logger.debug("removing machine: {}".format(machineid))
-    return '', 200
+    global registered_machines, todo_machines
+    app.logger.debug("removing machine: %s", machineid)
+    kind, key, mstate = _write(_delete_machine_record, machineid)
+    if kind is None:
+        return jsonify(error='Unknown machine {}'.format(machineid)), 404
+    if kind == 'todo':
+        return '', 200
+    if mstate in deletable_states:
+        try:
+            _unregister_machine(key)
+            return '', 200
+        except Exception as e:
+            app.logger.error('Got exception unregistering machine %s: %s', key, e, extra={'uuid': key})
+    # Left to the nodes driver
+    _write(_mark_unregistering, key)
+    _wake_node(key)
+    return '', 202
+
+
+# GET request handler to retrieve metrics in Prometheus text format
+@app.route('/metrics')
+@requires_auth
+def get_metrics():
+    return Response(_render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+# Record duration and response size of requests (per route)
+def _record_request(route, status, duration, size):
+    _observe('register_helper_request_duration_seconds', duration, route=route, status=status)
+    if size is not None:
+        _observe('register_helper_response_size_bytes', size, buckets=size_buckets, route=route)
+
+
+# Called first on each incoming request
+@app.before_request
+def _start_request():
+    g.request_start = time.time()
+
+
+# Called after each request
+@app.after_request
+def _end_request(response):
+    if 'request_start' in g:
+        _record_request(request.url_rule.rule if request.url_rule else 'unknown', response.status_code,
+                        time.time() - g.request_start, response.calculate_content_length())
+    return response
 
 
 # Called on each incoming request
 @app.before_request
 def _log_request_info():
-    app.logger.debug('Method: %s', request.method)
-    app.logger.debug('Headers: %s', request.headers)
-    app.logger.debug('Body: %s', request.get_data())
-    if request.method in ['DELETE', 'POST', 'PUT']:
-        mime_header = request.headers.get('Content-Type', "dummy/dummy").split('/')
+    # Headers and body are only retrieved if they are logged
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug('Method: %s', request.method)
+        app.logger.debug('Headers: %s', dict((k, '<hidden>' if k == 'Authorization' else v)
+                                             for k, v in request.headers.items()))
+        # Bulk registrations are parsed while being received (not buffered)
+        if request.endpoint != 'add_machines':
+            app.logger.debug('Body: %s', request.get_data())
+    # Request body is optional for DELETE requests
+    if request.method in ['POST', 'PUT'] or (request.method == 'DELETE' and request.mimetype):
+        mime_header = (request.mimetype or "dummy/dummy").split('/')
         if (mime_header[0] not in ['text', 'application'] or
                 mime_header[1] not in ['csv', 'x-csv', 'json', 'yaml', 'x-yaml']):
             abort(400)
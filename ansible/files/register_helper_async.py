@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+# asyncio serving mode of the register-helper utility agent
+#
+# Requires python >= 3.5, the modules needed by register_helper.py (which
+# must be located in the same directory) and the following ones
+#
+# pip install -U aiohttp
+#
+# Usage: register_helper_async.py [-H <host>] [-p <port>]
+#
+# - machines views (/status, /machines, /waiting, /dump) are served by the
+#   event loop from serialized snapshots of the inventory (rebuilt once per
+#   inventory revision) and watch requests wait for changes without holding
+#   any thread
+# - Ironic and keystone calls are run by a pool of threads (executor), the
+#   event loop never calls Ironic nor waits for inventory locks
+# - inventory changes (Ironic polls merge, registrations, states driver,
+#   loading of other workers changes, ...) and their persistence are applied
+#   one at a time by a single writer thread (register_helper.inventory_writer)
+# - polls of Ironic, the provisioning states driver and the loading of
+#   changes made by other workers are asyncio tasks replacing the
+#   background scheduler of register_helper.py
+# - other requests are handed over to the Flask application of
+#   register_helper.py
+
+# System imports
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import sys
+import threading
+
+# Asynchronous web service imports
+from aiohttp import web
+
+# Flask request handling
+from flask import request as flask_request
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+
+class AsyncRegisterHelper(object):
+    ''' asyncio front end of register_helper module '''
+
+    # Views served by the event loop: URL -> (view name, builder name)
+    view_routes = {
+        '/dump': ('dump', '_build_dump_view'),
+        '/machines': ('machines', '_build_machines_view'),
+        '/status': ('status', '_build_status_view'),
+        '/waiting': ('waiting', '_build_waiting_view'),
+    }
+
+    def __init__(self, helper):
+        self.helper = helper
+        # Ironic and keystone calls, views serialization
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(helper.fetch_workers)
+        # Inventory changes
+        self.writer = concurrent.futures.ThreadPoolExecutor(1)
+        self.writer_local = threading.local()
+        self.loop = None
+        self.tasks = []
+        # Views being built: name -> future
+        self.building = {}
+        # Resolved (and replaced) after each batch of inventory changes
+        self.changed = None
+
+    # Run blocking function in given executor
+    def _run(self, executor, func, *args):
+        return self.loop.run_in_executor(executor, func, *args)
+
+    # Inventory writer of helper: changes are applied by writer thread (run
+    # right away if already applied by writer thread)
+    def _write(self, func, *args):
+        if getattr(self.writer_local, 'active', False):
+            return func(*args)
+        return self.writer.submit(self._apply, func, args).result()
+
+    def _apply(self, func, args):
+        self.writer_local.active = True
+        return func(*args)
+
+    # Inventory listener called from any thread
+    def _inventory_changed(self):
+        self.loop.call_soon_threadsafe(self._notify_changed)
+
+    def _notify_changed(self):
+        changed, self.changed = self.changed, self.loop.create_future()
+        changed.set_result(None)
+
+    # WSGI environment of request
+    def _environ(self, request, body):
+        builder = EnvironBuilder(path=request.path, method=request.method,
+                                 query_string=request.query_string,
+                                 headers=list(request.headers.items()), data=body,
+                                 environ_base={'REMOTE_ADDR': request.remote or ''})
+        try:
+            return builder.get_environ()
+        finally:
+            builder.close()
+
+    # Check HTTP basic authentication (keystone is only called on cache misses)
+    async def _authorized(self, authorization):
+        helper = self.helper
+        if helper.shade_opts.get('auth_type', None) != 'password':
+            return True
+        if not authorization:
+            return False
+        cached = helper._auth_cache_get(helper._credentials_key(
+            authorization.username, authorization.password))
+        if cached is not None:
+            return cached
+        return await self._run(self.io_executor, helper.verify_password,
+                               authorization.username, authorization.password)
+
+    # View for current inventory revision (built once by a thread)
+    async def _get_view(self, name, builder):
+        view = self.helper._cached_view(name)
+        if view is not None:
+            return view
+        building = self.building.get(name)
+        if building is None:
+            building = asyncio.ensure_future(self._run(self.io_executor, self.helper._get_view, name, builder))
+            self.building[name] = building
+            building.add_done_callback(lambda f: self.building.pop(name, None))
+        return await asyncio.shield(building)
+
+    # GET request handler of machines views (same behaviour as Flask ones)
+    async def handle_view(self, request):
+        start = self.loop.time()
+        response = await self._handle_view(request)
+        self.helper._record_request(request.path, response.status, self.loop.time() - start,
+                                    response.content_length)
+        return response
+
+    async def _handle_view(self, request):
+        helper = self.helper
+        name, builder = self.view_routes[request.path]
+        with helper.app.request_context(self._environ(request, b'')):
+            try:
+                name, view_builder = helper._view_request(name, getattr(helper, builder))
+            except HTTPException as e:
+                return web.Response(status=e.code, text=e.description)
+            authorization = flask_request.authorization
+            wait = min(flask_request.args.get('wait', 0, type=float), helper.max_wait)
+            since = flask_request.args.get('since', helper.inventory_revision, type=int)
+            if_none_match = flask_request.if_none_match
+        if not await self._authorized(authorization):
+            return web.Response(status=401, headers={'WWW-Authenticate': 'Basic realm="Authentication Required"'})
+        deadline = self.loop.time() + wait
+        view = await self._get_view(name, view_builder)
+        # Watch request: wait until view content changes after given revision
+        while wait > 0 and view['changed'] <= since:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            changed = self.changed
+            # Only sleep if no change occurred since view was retrieved
+            if view['revision'] == helper.inventory_revision:
+                try:
+                    await asyncio.wait_for(asyncio.shield(changed), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            view = await self._get_view(name, view_builder)
+        headers = {'ETag': '"{}"'.format(view['etag']), 'X-Inventory-Revision': str(view['revision']),
+                   'X-Inventory-Stale': 'true' if helper.inventory_stale else 'false'}
+        if if_none_match.contains(view['etag']):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=view['body'], content_type='application/json', headers=headers)
+
+    # Other requests are handled by Flask application in executor threads
+    # (inventory changes are handed over to writer thread)
+    async def handle_flask(self, request):
+        helper = self.helper
+        body = await request.read()
+        environ = self._environ(request, body)
+        with helper.app.request_context(environ):
+            authorization = flask_request.authorization
+        if not await self._authorized(authorization):
+            return web.Response(status=401, headers={'WWW-Authenticate': 'Basic realm="Authentication Required"'})
+        status, headers, body = await self._run(self.io_executor, self._call_flask, environ)
+        return web.Response(body=body, status=status, headers=headers)
+
+    def _call_flask(self, environ):
+        app_iter, status, headers = run_wsgi_app(self.helper.app, environ, buffered=True)
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        headers = [(k, v) for k, v in headers.items() if k.lower() not in ['content-length', 'transfer-encoding']]
+        return int(status.split()[0]), headers, body
+
+    # Periodic polls of Ironic shards (polling worker only): calls are made
+    # by executor threads, machines merged and shards states recorded by
+    # writer thread
+    async def poll_inventory(self):
+        helper = self.helper
+        # 1st synchronization with Ironic (persisted state is served meanwhile)
+        await self._run(self.io_executor, helper._warm_up)
+        await asyncio.gather(*[self.poll_shard(shard) for shard in helper.shards])
+
+    # Periodic poll of one shard (independent schedule, failing shards are
+    # polled again with exponential backoff)
+    async def poll_shard(self, shard):
+        helper = self.helper
+        start = self.loop.time()
+        while True:
+            await asyncio.sleep(max(0, helper.poll_interval - (self.loop.time() - start)))
+            start = self.loop.time()
+            if not helper.poll_leader or not helper._shard_due(shard):
+                await asyncio.sleep(1)
+                continue
+            try:
+                await self._run(self.io_executor, helper._poll_shard, shard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                helper.app.logger.error('Got exception polling shard %s: %s', shard, e, extra={'shard': shard})
+
+    # Periodic dispatch of provisioning state transitions (polling worker
+    # only): Ironic calls are made by transition threads
+    async def drive_nodes(self):
+        helper = self.helper
+        while True:
+            try:
+                if helper.poll_leader:
+                    await self._run(self.io_executor, helper._drive_nodes)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                helper.app.logger.error('Got exception driving nodes: %s', e)
+            await asyncio.sleep(helper.driver_interval)
+
+    # Periodic loading of changes made by other workers (Ironic is polled by
+    # executor thread when replacing polling worker)
+    async def sync_store(self):
+        helper = self.helper
+        while True:
+            try:
+                await self._run(self.io_executor, helper._sync_shared_store)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                helper.app.logger.error('Got exception loading shared store: %s', e)
+            await asyncio.sleep(helper.store_refresh_interval)
+
+    async def on_startup(self, app):
+        self.loop = asyncio.get_event_loop()
+        self.changed = self.loop.create_future()
+        self.helper.inventory_writer = self._write
+        self.helper.inventory_listeners.append(self._inventory_changed)
+        self.tasks = [asyncio.ensure_future(self.poll_inventory()),
+                      asyncio.ensure_future(self.drive_nodes()),
+                      asyncio.ensure_future(self.sync_store())]
+
+    async def on_cleanup(self, app):
+        self.helper.inventory_listeners.remove(self._inventory_changed)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        # Executor threads may still hand over changes to writer thread
+        self.io_executor.shutdown()
+        self.helper.inventory_writer = None
+        self.writer.shutdown()
+        self.helper._close_pools()
+
+    # aiohttp application
+    def make_app(self):
+        app = web.Application()
+        for path in self.view_routes:
+            app.router.add_get(path, self.handle_view)
+        app.router.add_route('*', '/{tail:.*}', self.handle_flask)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='register-helper utility agent (asyncio serving mode)')
+    parser.add_argument('-H', '--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=7777, help='port to listen on')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    import register_helper
+    # Persisted state is served right away, warm-up, polls and states driver
+    # are run by asyncio tasks
+    register_helper._restore_state()
+    web.run_app(AsyncRegisterHelper(register_helper).make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+# Store facts (e.g. filtered hostvars) as JSON into a destination file and
+# optionally one file per host (shards) in a directory
+#
+# - hostvars entries are selected by the plugin itself (only selected
+#   entries are templated, no JSON string is built by the template engine)
+# - facts are encoded incrementally into a local temporary file (the whole
+#   JSON document is never built in memory) while its SHA1 is computed
+# - destination files are only transferred and rewritten (by copy action)
+#   when their checksum differs (unless force is set), changed shards are
+#   transferred at once (archive extracted by unarchive action) and shards
+#   of hosts which are not part of facts anymore are removed
+#
+# Arguments:
+# - facts: mapping to store (host -> entries for shards), hostvars entries
+#   selected by include_keys and exclude_keys if not given
+# - include_keys: patterns of hostvars entries to store (all if empty)
+# - exclude_keys: patterns of hostvars entries not to store (precedence over
+#   include_keys)
+# - dest: destination file
+# - shards_dir: directory of per-host files (<host>.json), optional
+# - once: existing files are left untouched (e.g. snapshots including
+#   volatile facts which would change them on each run)
+# - merge: entries of hosts already stored in destination file but not
+#   selected anymore are kept (e.g. file stored by several tasks with
+#   different patterns)
+# - force: rewrite files even if their content is unchanged (or exists)
+# - mode: mode of written files, optional (octal for shards)
+
+import base64
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+
+from ansible.errors import AnsibleActionFail
+from ansible.module_utils.six import integer_types, iteritems, string_types
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+
+try:
+    from ansible.module_utils.common.json import AnsibleJSONEncoder
+except ImportError:
+    from ansible.parsing.ajson import AnsibleJSONEncoder
+
+
+# Selection function of hostvars entries (patterns matched at the beginning
+# of keys like re.match, exclude ones have precedence, decisions memoized
+# per key)
+def key_selector(include_keys, exclude_keys):
+    for name, patterns in [('include_keys', include_keys), ('exclude_keys', exclude_keys)]:
+        if not isinstance(patterns, list) or not all(isinstance(p, string_types) for p in patterns):
+            raise AnsibleActionFail('{} must be a list of strings (got {})'.format(name, patterns))
+    if len(include_keys) == 0 and len(exclude_keys) == 0:
+        raise AnsibleActionFail('include_keys and exclude_keys can not be both empty')
+    try:
+        include = [re.compile(p) for p in include_keys]
+        exclude = [re.compile(p) for p in exclude_keys]
+    except re.error as e:
+        raise AnsibleActionFail('Invalid include_keys or exclude_keys pattern: {}'.format(e))
+    decisions = {}
+
+    def selected(key):
+        decision = decisions.get(key)
+        if decision is None:
+            decision = (not any(p.match(key) for p in exclude) and
+                        (len(include) == 0 or any(p.match(key) for p in include)))
+            decisions[key] = decision
+        return decision
+    return selected
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = True
+
+    # Selected entries of each host of hostvars (hosts without any selected
+    # entry are left out), only for given hosts if any
+    def _select_hostvars(self, hostvars, selected, hosts=None):
+        facts = {}
+        for host in (hostvars if hosts is None else hosts):
+            host_vars = hostvars[host]
+            entries = dict((k, host_vars[k]) for k in host_vars if selected(k))
+            if len(entries) > 0:
+                facts[host] = entries
+        return facts
+
+    # Encode value as JSON (same layout as to_nice_json) into a local file
+    # (temporary one if not given) chunk by chunk: returns path and SHA1 of
+    # file
+    def _encode_to_file(self, value, path=None):
+        encoder = AnsibleJSONEncoder(indent=4, sort_keys=True, separators=(',', ': '))
+        digest = hashlib.sha1()
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='store_facts_', suffix='.json')
+        else:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in encoder.iterencode(value):
+                data = chunk.encode('utf-8')
+                digest.update(data)
+                f.write(data)
+            digest.update(b'\n')
+            f.write(b'\n')
+        return path, digest.hexdigest()
+
+    # Run another action (copy, unarchive) with given arguments
+    def _run_action(self, name, args, task_vars):
+        new_task = self._task.copy()
+        new_task.args = args
+        action = self._shared_loader_obj.action_loader.get(
+            name,
+            task=new_task,
+            connection=self._connection,
+            play_context=self._play_context,
+            loader=self._loader,
+            templar=self._templar,
+            shared_loader_obj=self._shared_loader_obj)
+        action_res = action.run(task_vars=task_vars)
+        if action_res.get('failed'):
+            raise AnsibleActionFail('Failed to write {}: {}'.format(args['dest'], action_res.get('msg', action_res)))
+        return action_res
+
+    # Write local file to destination with copy action
+    def _copy_file(self, src, dest, task_vars):
+        args = {'src': src, 'dest': dest, 'force': True}
+        if self._task.args.get('mode') is not None:
+            args['mode'] = self._task.args['mode']
+        return self._run_action('copy', args, task_vars)
+
+    # Facts stored in destination file (empty if they can not be decoded)
+    def _read_stored(self, dest, task_vars):
+        res = self._execute_module(module_name='slurp', module_args={'src': dest}, task_vars=task_vars)
+        if res.get('failed'):
+            raise AnsibleActionFail('Failed to read {}: {}'.format(dest, res.get('msg')))
+        try:
+            stored = json.loads(base64.b64decode(res['content']).decode('utf-8'))
+        except ValueError:
+            return {}
+        return stored if isinstance(stored, dict) else {}
+
+    # Store value into destination if its content differs from given
+    # checksum (None if file does not exist): returns whether file changed
+    def _store(self, value, dest, checksum, force, task_vars):
+        path, digest = self._encode_to_file(value)
+        try:
+            if digest == checksum and not force:
+                return False
+            return self._copy_file(path, dest, task_vars).get('changed', False)
+        finally:
+            os.remove(path)
+
+    # Remove shards of hosts which are not part of given ones anymore:
+    # returns these hosts
+    def _prune_shards(self, hosts, paths, task_vars):
+        removed = []
+        for path in sorted(paths):
+            host = os.path.basename(path)[:-len('.json')]
+            if host in hosts:
+                continue
+            res = self._execute_module(
+                module_name='file',
+                module_args={'path': path, 'state': 'absent'},
+                task_vars=task_vars)
+            if res.get('failed'):
+                raise AnsibleActionFail('Failed to remove {}: {}'.format(path, res.get('msg')))
+            removed.append(host)
+        return removed
+
+    # Store per-host facts (given by get_facts for the hosts whose shard is
+    # missing if once is set, all hosts otherwise) into shards directory
+    # (checksums of existing shards retrieved at once, changed ones
+    # transferred in a single archive, stale ones removed): returns hosts
+    # whose shard changed and hosts whose shard was removed
+    def _store_shards(self, get_facts, hosts, shards_dir, once, force, task_vars):
+        found = self._execute_module(
+            module_name='find',
+            module_args={'paths': shards_dir, 'patterns': '*.json', 'get_checksum': True},
+            task_vars=task_vars)
+        checksums = dict((f['path'], f.get('checksum')) for f in found.get('files', []))
+        if len(checksums) == 0:
+            dir_res = self._execute_module(
+                module_name='file',
+                module_args={'path': shards_dir, 'state': 'directory'},
+                task_vars=task_vars)
+            if dir_res.get('failed'):
+                raise AnsibleActionFail('Failed to create {}: {}'.format(shards_dir, dir_res.get('msg')))
+        if once and not force:
+            # Existing shards are kept as is
+            existing = set(h for h in hosts if os.path.join(shards_dir, '{}.json'.format(h)) in checksums)
+            facts = get_facts([h for h in hosts if h not in existing])
+        else:
+            existing = set()
+            facts = get_facts(None)
+        # Mode of shards (octal, given as string or integer)
+        mode = self._task.args.get('mode', 0o644)
+        if not isinstance(mode, integer_types):
+            mode = int(str(mode), 8)
+        local_dir = tempfile.mkdtemp(prefix='store_facts_')
+        try:
+            archive = os.path.join(local_dir, 'shards.tar.gz')
+            changed = []
+            with tarfile.open(archive, 'w:gz') as tar:
+                for host, host_facts in sorted(iteritems(facts)):
+                    name = '{}.json'.format(host)
+                    path, digest = self._encode_to_file(host_facts, os.path.join(local_dir, name))
+                    if digest != checksums.get(os.path.join(shards_dir, name)) or force:
+                        info = tar.gettarinfo(path, name)
+                        info.mode = mode
+                        info.uid = info.gid = 0
+                        info.uname = info.gname = ''
+                        with open(path, 'rb') as f:
+                            tar.addfile(info, f)
+                        changed.append(host)
+                    os.remove(path)
+            if len(changed) > 0:
+                self._run_action('unarchive', {'src': archive, 'dest': shards_dir}, task_vars)
+        finally:
+            shutil.rmtree(local_dir, ignore_errors=True)
+        # Hosts without any selected entry have no shard either
+        return changed, self._prune_shards(set(facts) | existing, checksums.keys(), task_vars)
+
+    def run(self, tmp=None, task_vars=None):
+
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        facts = self._task.args.get('facts')
+        dest = self._task.args.get('dest')
+        shards_dir = self._task.args.get('shards_dir')
+        once = boolean(self._task.args.get('once', False), strict=False)
+        merge = boolean(self._task.args.get('merge', False), strict=False)
+        force = boolean(self._task.args.get('force', False), strict=False)
+        if facts is None:
+            hostvars = task_vars.get('hostvars', {})
+            selected = key_selector(self._task.args.get('include_keys', []), self._task.args.get('exclude_keys', []))
+            hosts = list(hostvars)
+
+            def get_facts(for_hosts):
+                return self._select_hostvars(hostvars, selected, for_hosts)
+        elif isinstance(facts, dict):
+            hosts = list(facts)
+
+            def get_facts(for_hosts):
+                return facts if for_hosts is None else dict((h, facts[h]) for h in for_hosts if h in facts)
+        else:
+            raise AnsibleActionFail('facts must be a mapping (got {})'.format(type(facts)))
+        if not dest:
+            raise AnsibleActionFail('dest is required')
+
+        try:
+            dest_stat = self._execute_remote_stat(dest, all_vars=task_vars, follow=True)
+            checksum = dest_stat.get('checksum') if dest_stat.get('exists') else None
+            result['dest'] = dest
+            if once and checksum is not None and not force:
+                result['changed'] = False
+            else:
+                value = get_facts(None)
+                if merge and checksum is not None:
+                    stored = self._read_stored(dest, task_vars)
+                    for host, entries in iteritems(value):
+                        if isinstance(stored.get(host), dict):
+                            stored[host] = dict(stored[host], **entries)
+                        else:
+                            stored[host] = entries
+                    value = stored
+                result['changed'] = self._store(value, dest, checksum, force, task_vars)
+            if shards_dir:
+                result['shards_changed'], result['shards_removed'] = self._store_shards(
+                    get_facts, hosts, shards_dir, once, force, task_vars)
+                result['changed'] = (result['changed'] or len(result['shards_changed']) > 0 or
+                                     len(result['shards_removed']) > 0)
+        finally:
+            self._remove_tmp_path(self._connection._shell.tmpdir)
+        return result
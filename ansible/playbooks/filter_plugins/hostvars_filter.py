@@ -10,12 +10,74 @@ ANSIBLE_METADATA = {
     'supported_by': 'OpenNext'
 }
 
+import collections
 import json
 import re
+import threading
 
 from ansible.errors import AnsibleFilterError
 from ansible.module_utils.six import string_types
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+# Match function of patterns (matched at the beginning of keys like
+# re.match), None if there is no pattern
+# Patterns are combined into a single alternation unless they contain
+# groups (backreferences would be renumbered) or can not be combined
+def compile_patterns(patterns):
+    if len(patterns) == 0:
+        return None
+    compiled = [re.compile(p) for p in patterns]
+    if all(p.groups == 0 for p in compiled):
+        try:
+            return re.compile('|'.join('(?:%s)' % p for p in patterns)).match
+        except re.error:
+            pass
+    return lambda key: any(p.match(key) for p in compiled)
+
+
+class KeyFilter(object):
+    ''' Include and exclude patterns compiled once, decision memoized per key '''
+
+    def __init__(self, include_keys, exclude_keys):
+        self.include = compile_patterns(include_keys)
+        self.exclude = compile_patterns(exclude_keys)
+        # Decisions already taken: key -> selected or not
+        self.decisions = {}
+
+    def selected(self, key):
+        decision = self.decisions.get(key)
+        if decision is None:
+            # Exclude has precedence over include
+            decision = not (self.exclude and self.exclude(key)) and (self.include is None or bool(self.include(key)))
+            self.decisions[key] = decision
+        return decision
+
+
+# Key filters of patterns used so far (bounded LRU cache, per process):
+# (include patterns, exclude patterns) -> KeyFilter
+key_filters = collections.OrderedDict()
+key_filters_size = 16
+key_filters_lock = threading.Lock()
+
+
+# Key filter of include and exclude patterns (compiled once)
+def get_key_filter(include_keys, exclude_keys):
+    key = (tuple(include_keys), tuple(exclude_keys))
+    with key_filters_lock:
+        key_filter = key_filters.pop(key, None)
+        if key_filter is None:
+            key_filter = KeyFilter(include_keys, exclude_keys)
+        key_filters[key] = key_filter
+        while len(key_filters) > key_filters_size:
+            key_filters.popitem(last=False)
+    return key_filter
+
+
 # ---- Ansible filters ----
 class FilterModule(object):
     ''' hostvars entries filter '''
@@ -25,8 +87,10 @@ class FilterModule(object):
             'hostvars_filter': self.hostvars_filter
         }
 
+    # Filter entries of each host of hostvars given either directly (mapping:
+    # only selected entries are templated) or as a JSON string
     def hostvars_filter(self, value, include_keys = [], exclude_keys = []):
-        if not isinstance(value, string_types):
+        if not isinstance(value, (string_types, Mapping)):
             raise AnsibleFilterError('Invalid value type (%s) for hostvars_filter (%s)' % (type(value), value))
         if not isinstance(include_keys, list):
             raise AnsibleFilterError('Invalid matching keys type (%s) for hostvars_filter (%s)' % (type(include_keys), include_keys))
@@ -35,40 +99,29 @@ class FilterModule(object):
         if len(include_keys) == 0 and len(exclude_keys) == 0:
             raise AnsibleFilterError('List of matching and non matching keys can not be both empty for hostvars_filter')
         if len(include_keys) > 0:
-            not_strings = list(filter(lambda x: not isinstance(x, string_types), include_keys))
+            not_strings = [x for x in include_keys if not isinstance(x, string_types)]
             if len(not_strings) > 0:
                 raise AnsibleFilterError('Invalid matching keys type (not strings) for hostvars_filter items (%s)' % (not_strings))
         if len(exclude_keys) > 0:
-            not_strings = list(filter(lambda x: not isinstance(x, string_types), exclude_keys))
+            not_strings = [x for x in exclude_keys if not isinstance(x, string_types)]
             if len(not_strings) > 0:
                 raise AnsibleFilterError('Invalid non matching keys type (not strings) for hostvars_filter items (%s)' % (not_strings))
-        ret = {}
         try:
-            to_parse = json.loads(value)
-            # Level 1 is host key
-            for k,v in iter(to_parse.items()):
-                lret = {}
-                # Level 2 is entries to be matched
-                for lk,lv in iter(v.items()):
-                    # Exclude has precedence over include
-                    to_exclude = False
-                    for m in exclude_keys:
-                        if re.match(m, lk):
-                            to_exclude = True
-                            break
-                    # Go on with next key, this one is excluded
-                    if to_exclude:
-                        continue
-                    if len(include_keys):
-                        for m in include_keys:
-                            if re.match(m, lk):
-                                lret[lk] = lv
-                                break
-                    else:
-                        lret[lk] = lv
-                if len(lret.keys()) > 0:
-                    ret[k] = lret
-        except Exception as e:
-            raise AnsibleFilterError('Invalid JSON value for hostvars_filter (%s): %s' % (not_strings, e)) 
+            key_filter = get_key_filter(include_keys, exclude_keys)
+        except re.error as e:
+            raise AnsibleFilterError('Invalid matching or non matching keys pattern for hostvars_filter: %s' % (e))
+        if isinstance(value, string_types):
+            try:
+                value = json.loads(value)
+            except Exception as e:
+                raise AnsibleFilterError('Invalid JSON value for hostvars_filter: %s' % (e))
+        ret = {}
+        selected = key_filter.selected
+        # Level 1 is host key
+        for k in value:
+            v = value[k]
+            # Level 2 is entries to be matched
+            lret = dict((lk, v[lk]) for lk in v if selected(lk))
+            if len(lret) > 0:
+                ret[k] = lret
         return ret
-
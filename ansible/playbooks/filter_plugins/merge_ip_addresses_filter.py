@@ -10,69 +10,179 @@ ANSIBLE_METADATA = {
     'supported_by': 'OpenNext'
 }
 
+import bisect
+import collections
+import hashlib
+import json
+import threading
+
 from netaddr import *
 
 from ansible.errors import AnsibleFilterError
 from ansible.module_utils.six import iteritems, string_types, integer_types
 
-def cmd_ip_addresses(x, y):
-
-    if ',' in x:
-        a = IPAddress(x.split(',')[0])
-    else:
-        a = IPAddress(x)
-    if ',' in y:
-        b = IPAddress(y.split(',')[0])
-    else:
-        b = IPAddress(y)
-    if a > b:
-        return 1
-    if a < b:
-        return -1
-    return 0
+
+# Parse IP address or range string ('x' or 'x,y') into an interval of
+# integers: (version, first, last), None if invalid
+def parse_ip_or_range(ip_str):
+    ips = ip_str.split(',')
+    if len(ips) > 2:
+        return None
+    try:
+        addrs = [IPAddress(ip) for ip in ips]
+    except Exception:
+        return None
+    first, last = addrs[0], addrs[-1]
+    if first.version != last.version or first > last:
+        return None
+    return (first.version, int(first), int(last))
+
+
+# Parsed IP addresses and ranges lists (bounded LRU cache, per process):
+# hash of list -> tuple of intervals (None for invalid entries)
+parse_cache = collections.OrderedDict()
+parse_cache_size = 32
+parse_cache_lock = threading.Lock()
+
+
+# Intervals of IP addresses and ranges list (None for invalid entries):
+# identical lists (e.g. same variable templated for each host) are only
+# parsed once
+def parse_ip_list(ips):
+    key = hashlib.sha1(json.dumps(ips).encode('utf-8')).hexdigest()
+    with parse_cache_lock:
+        intervals = parse_cache.pop(key, None)
+        if intervals is not None:
+            parse_cache[key] = intervals
+            return intervals
+    intervals = tuple(parse_ip_or_range(ip_str) for ip_str in ips)
+    with parse_cache_lock:
+        parse_cache[key] = intervals
+        while len(parse_cache) > parse_cache_size:
+            parse_cache.popitem(last=False)
+    return intervals
+
+
+# Sort key of IP addresses and ranges (by their first address)
+def ip_sort_key(interval):
+    return interval[:2]
+
+
+# Merge IP addresses and ranges given as (interval, string) pairs:
+# - overlapping and adjacent ranges are coalesced into a single range
+# - single IPs which belong to some range are absorbed by that range
+# Returns sorted list of strings (merged ranges as 'x,y', other entries as given)
+def merge_intervals(entries):
+    ranges = []
+    singles = {}
+    for interval, ip_str in sorted(entries):
+        version, first, last = interval
+        if ',' not in ip_str:
+            # Duplicated single IPs are only kept once
+            singles.setdefault(interval, ip_str)
+        elif ranges and ranges[-1][0][0] == version and ranges[-1][0][2] + 1 >= first:
+            # Overlaps or extends previous range (string built once merged)
+            rversion, rfirst, rlast = ranges[-1][0]
+            if last > rlast:
+                ranges[-1] = ((version, rfirst, last), None)
+        else:
+            ranges.append((interval, ip_str))
+    # Coalesced ranges are sorted: binary search of the one each IP may belong to
+    starts = [ip_sort_key(interval) for interval, _ in ranges]
+    merged = []
+    for interval, ip_str in ranges:
+        if ip_str is None:
+            version, first, last = interval
+            ip_str = '{},{}'.format(IPAddress(first, version), IPAddress(last, version))
+        merged.append((interval, ip_str))
+    for interval, ip_str in iteritems(singles):
+        idx = bisect.bisect_right(starts, ip_sort_key(interval)) - 1
+        if idx >= 0 and ranges[idx][0][0] == interval[0] and ranges[idx][0][2] >= interval[1]:
+            continue
+        merged.append((interval, ip_str))
+    merged.sort(key=lambda x: ip_sort_key(x[0]))
+    return [ip_str for _, ip_str in merged]
+
+
+# Sorted list of disjoint intervals covering all given intervals (overlapping
+# and adjacent ones coalesced)
+def coalesce_intervals(intervals):
+    coalesced = []
+    for version, first, last in sorted(intervals):
+        if coalesced and coalesced[-1][0] == version and coalesced[-1][2] + 1 >= first:
+            if last > coalesced[-1][2]:
+                coalesced[-1] = (version, coalesced[-1][1], last)
+        else:
+            coalesced.append((version, first, last))
+    return coalesced
+
+
+# Usable addresses of network as an interval: network address (and broadcast
+# one for IPv4) excluded unless network is too small to have them
+def network_interval(network):
+    first, last = network.first, network.last
+    if last - first >= 2 or (network.version == 6 and last > first):
+        first += 1
+        if network.version == 4:
+            last -= 1
+    return (network.version, first, last)
+
+
+# Free intervals of network interval (bounded to count addresses if given)
+# given the coalesced reserved intervals: the address space is never
+# enumerated, reserved intervals preceding the network are skipped by
+# binary search
+def free_intervals(net_interval, reserved, count=None):
+    version, first, last = net_interval
+    idx = bisect.bisect_left(reserved, (version, first, first))
+    # Previous reserved interval may cover beginning of network
+    if idx > 0 and reserved[idx - 1][0] == version and reserved[idx - 1][2] >= first:
+        idx -= 1
+    free = []
+    current = first
+    while current <= last and (count is None or count > 0):
+        # Gap up to next reserved interval (or end of network)
+        if idx < len(reserved) and reserved[idx][0] == version and reserved[idx][1] <= last:
+            end, next_current = reserved[idx][1] - 1, reserved[idx][2] + 1
+            idx += 1
+        else:
+            end, next_current = last, last + 1
+        if end >= current:
+            if count is not None:
+                end = min(end, current + count - 1)
+                count -= end - current + 1
+            free.append((version, current, end))
+        current = max(current, next_current)
+    return free
+
 
 # ---- Ansible filters ----
 class FilterModule(object):
-    ''' IP adresses and ranges merge filter '''
-
-    def __init__(self):
-        self.ip_dict = {}
-        self.network_list = []
+    ''' IP adresses and ranges merge (and free addresses) filters '''
 
     def filters(self):
         return {
-            'merge_ip_addresses': self.merge_ip_addresses
+            'merge_ip_addresses': self.merge_ip_addresses,
+            'free_ip_addresses': self.free_ip_addresses,
+            'free_ip_ranges': self.free_ip_ranges,
         }
 
     # Check validity of IP network string
     # Expected format: x.x.x.x/y.y.y.y
     def is_valid_network(self, network_str):
         try:
-            ok_net = IPNetwork(network_str)
-        except Exception as e:
+            IPNetwork(network_str)
+        except Exception:
             return False
-        self.network_list.append(ok_net)
         return True
 
-    # Only accept valid IP addresses or pairs of valid addresses
-    # separated by a comma
+    # Only accept valid IP addresses or pairs of valid addresses (of the
+    # same version, in increasing order) separated by a comma
     def is_valid_ip_or_range(self, ip_str):
-        ips = ip_str.split(',')
-        if len(ips) > 2:
-            return False
-        tmp_ips = []
-        for ip in ips:
-            try:
-                ok_ip = IPAddress(ip)
-            except Exception as e:
-                return False
-            tmp_ips.append(ok_ip)
-        if len(ips) == 1:
-            self.ip_dict[ip_str] = tmp_ips
-        else:
-            self.ip_dict[ip_str] = list(iter_iprange(ips[0], ips[1]))
-        return True
+        return parse_ip_or_range(ip_str) is not None
 
+    # Merged IP addresses and ranges (each call only works on its own
+    # arguments, nothing is kept between calls but the cache of parsed lists)
     def merge_ip_addresses(self, ips, networks = []):
         # Check network parameter type
         if not isinstance(networks, list):
@@ -80,7 +190,7 @@ class FilterModule(object):
         # Networks list with CIDR notation
         if len(networks) > 0:
             # Check validity of individual network list elements
-            bad_networks = filter(lambda x: not self.is_valid_network(x), networks)
+            bad_networks = [x for x in networks if not self.is_valid_network(x)]
             if len(bad_networks) > 0:
                 raise AnsibleFilterError('Invalid network addresses (not a valid network address) for merge_ip_addresses network list parameter (%s)' % (bad_networks))
         # Check ips parameter type
@@ -89,23 +199,58 @@ class FilterModule(object):
         if len(ips) == 0:
             raise AnsibleFilterError('IP addresses list can not be both empty for merge_ip_addresses')
         # Check individual ips list elements type
-        not_strings = filter(lambda x: not isinstance(x, string_types), ips)
+        not_strings = [x for x in ips if not isinstance(x, string_types)]
         if len(not_strings) > 0:
             raise AnsibleFilterError('Invalid IP address type (not strings) for merge_ip_addresses items (%s)' % (not_strings))
         # Check validity of individual ips list elements
-        bad_ranges = filter(lambda x: not self.is_valid_ip_or_range(x), ips)
+        intervals = parse_ip_list(ips)
+        bad_ranges = [x for x, interval in zip(ips, intervals) if interval is None]
         if len(bad_ranges) > 0:
             raise AnsibleFilterError('Invalid IP addresses (not a valid IP address or address range) for merge_ip_addresses items (%s)' % (bad_ranges))
-        # Check if single ips belong to some range ips
-        single_ips = filter(lambda x: ',' not in x, self.ip_dict.keys())
-        range_ips = filter(lambda x: ',' in x, self.ip_dict.keys())
-        for ip in single_ips:
-            # Not deleted already (safety)
-            if self.ip_dict.get(ip):
-                for range in range_ips:
-                    if self.ip_dict[ip][0] in self.ip_dict[range]:
-                        del self.ip_dict[ip]
-                        break
-        ret_ips = self.ip_dict.keys()
-        ret_ips.sort(cmd_ip_addresses)
-        return ret_ips
+        # Coalesce ranges and absorb single ips belonging to some range
+        return merge_intervals(list(zip(intervals, ips)))
+
+    # Reserved intervals and parsed networks of free_ip_* filters arguments
+    def parse_free_ip_args(self, filter_name, ips, networks):
+        if not isinstance(ips, list):
+            raise AnsibleFilterError('Invalid value type (%s) for %s IP list (%s)' % (type(ips), filter_name, ips))
+        if not isinstance(networks, list) or len(networks) == 0:
+            raise AnsibleFilterError('Invalid value (%s) for %s network list parameter (non empty list expected)' % (networks, filter_name))
+        not_strings = [x for x in ips if not isinstance(x, string_types)]
+        if len(not_strings) > 0:
+            raise AnsibleFilterError('Invalid IP address type (not strings) for %s items (%s)' % (filter_name, not_strings))
+        intervals = parse_ip_list(ips)
+        bad_ranges = [x for x, interval in zip(ips, intervals) if interval is None]
+        if len(bad_ranges) > 0:
+            raise AnsibleFilterError('Invalid IP addresses (not a valid IP address or address range) for %s items (%s)' % (filter_name, bad_ranges))
+        parsed_networks = []
+        for network in networks:
+            try:
+                parsed_networks.append((network, IPNetwork(network)))
+            except Exception:
+                raise AnsibleFilterError('Invalid network address (%s) for %s network list parameter' % (network, filter_name))
+        return coalesce_intervals(intervals), parsed_networks
+
+    # First count free addresses of each network (dict: network -> list of
+    # addresses) given reserved IP addresses and ranges ('x' or 'x,y')
+    def free_ip_addresses(self, ips, networks, count=1):
+        reserved, parsed_networks = self.parse_free_ip_args('free_ip_addresses', ips, networks)
+        if not isinstance(count, integer_types) or count < 0:
+            raise AnsibleFilterError('Invalid count (%s) for free_ip_addresses (positive integer expected)' % (count))
+        ret = {}
+        for network, net in parsed_networks:
+            ret[network] = [str(IPAddress(value, version))
+                            for version, first, last in free_intervals(network_interval(net), reserved, count)
+                            for value in range(first, last + 1)]
+        return ret
+
+    # Free ranges of each network (dict: network -> list of 'x,y' ranges or
+    # 'x' single addresses) given reserved IP addresses and ranges
+    def free_ip_ranges(self, ips, networks):
+        reserved, parsed_networks = self.parse_free_ip_args('free_ip_ranges', ips, networks)
+        ret = {}
+        for network, net in parsed_networks:
+            ret[network] = [str(IPAddress(first, version)) if first == last else
+                            '{},{}'.format(IPAddress(first, version), IPAddress(last, version))
+                            for version, first, last in free_intervals(network_interval(net), reserved)]
+        return ret
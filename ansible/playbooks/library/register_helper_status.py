@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, OpenNext SAS
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+
+ANSIBLE_METADATA = {'metadata_version': '1.0',
+                    'status': ['preview'],
+                    'supported_by': 'OpenNext'}
+
+DOCUMENTATION = '''
+---
+module: register_helper_status
+short_description: Wait for nodes status from register-helper utility agent
+description:
+     - Watch the status of nodes known by the register-helper utility agent until enough nodes
+       are registered or have reached one of the expected provisioning states.
+     - Status changes are waited for by the agent itself (long polling) so that the module
+       returns as soon as the expected status is available.
+     - Only provisioning states are retrieved while waiting, full status is retrieved once at the end.
+options:
+  url:
+    description:
+      - URL of the status entrypoint of the register-helper utility agent
+    required: true
+  url_username:
+    description:
+      - Username for HTTP basic authentication
+  url_password:
+    description:
+      - Password for HTTP basic authentication
+  nodes_nb:
+    description:
+      - Number of nodes expected (ignored if I(node_name) is set)
+    default: 1
+  node_name:
+    description:
+      - Name of the single node expected (regular expression when I(states) is empty)
+  states:
+    description:
+      - Expected provisioning states, if empty nodes only need to be registered
+    default: []
+  fail_states:
+    description:
+      - Provisioning states which stop waiting as soon as one node reaches them
+    default: []
+  wait:
+    description:
+      - Maximum time (in seconds) the agent waits for a status change on each request
+    default: 30
+  timeout:
+    description:
+      - Maximum time (in seconds) to wait for the expected status
+    default: 900
+  retry_delay:
+    description:
+      - Time (in seconds) to wait before retrying a request which failed with a transient
+        error (agent unreachable or restarting, request timeout, server errors)
+    default: 5
+  auth_retries:
+    description:
+      - Number of consecutive authentication failures retried (e.g. while keystone is
+        unavailable) before giving up
+    default: 3
+requirements: []
+author: "OpenNext"
+'''
+
+EXAMPLES = '''
+# Wait for 3 nodes to be deployed
+- register_helper_status:
+    url: "http://{{ registration_ip }}:{{ registration_port }}/status"
+    url_username: "{{ user }}"
+    url_password: "{{ password }}"
+    nodes_nb: 3
+    states: ['active']
+    fail_states: ['deploy failed']
+  register: registered_status
+'''
+
+RETURN = '''
+json:
+    description: last status retrieved from the register-helper utility agent
+    returned: success
+    type: dictionary
+revision:
+    description: inventory revision of last status
+    returned: success
+    type: int
+elapsed:
+    description: number of seconds spent waiting
+    returned: success
+    type: int
+'''
+
+import json
+import re
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.urls import fetch_url, url_argument_spec
+from ansible.module_utils._text import to_text
+from ansible.module_utils.six.moves.urllib.parse import urlencode
+
+
+# Nodes of status considered
+def considered_nodes(status, node_name, match_name):
+    if node_name is None:
+        return list(status.values())
+    if match_name:
+        return [v for k, v in status.items() if re.match(node_name, k)]
+    return [status[node_name]] if node_name in status else []
+
+
+# Check if expected status is reached (or has failed)
+def status_reached(params, status):
+    states = params['states']
+    nodes = considered_nodes(status, params['node_name'], len(states) == 0)
+    expected = 1 if params['node_name'] is not None else params['nodes_nb']
+    if any(n.get('provision_state') in params['fail_states'] for n in nodes):
+        return True
+    if len(states) > 0:
+        nodes = [n for n in nodes if n.get('provision_state') in states]
+    return len(nodes) >= expected
+
+
+# Whether failed request may succeed if retried: agent unreachable or
+# request timeout (status -1), server errors and a few authentication
+# failures (keystone errors are reported as such by the agent)
+def is_transient(status, auth_failures, auth_retries):
+    return status == -1 or status >= 500 or (status == 401 and auth_failures < auth_retries)
+
+
+# Retrieve status with given query parameters (transient errors are retried
+# until timeout)
+def fetch_status(module, query, start):
+    url = module.params['url']
+    if len(query) > 0:
+        url += ('&' if '?' in url else '?') + urlencode(sorted(query.items()))
+    auth_failures = 0
+    while True:
+        resp, info = fetch_url(module, url, method='GET', timeout=module.params['wait'] + 30)
+        if info['status'] == 200:
+            break
+        if (not is_transient(info['status'], auth_failures, module.params['auth_retries']) or
+                time.time() + module.params['retry_delay'] - start >= module.params['timeout']):
+            module.fail_json(msg='Status request failed: {}'.format(info.get('msg')), status=info['status'],
+                             elapsed=int(time.time() - start))
+        auth_failures = auth_failures + 1 if info['status'] == 401 else 0
+        time.sleep(module.params['retry_delay'])
+    content = resp.read()
+    try:
+        status = json.loads(to_text(content))
+    except ValueError as e:
+        module.fail_json(msg='Invalid status content: {}'.format(e))
+    revision = int(info.get('x-inventory-revision', 0))
+    return status, revision, dict(changed=False, json=status, revision=revision,
+                                  elapsed=int(time.time() - start),
+                                  status=info['status'], content_length=len(content))
+
+
+def main():
+    argument_spec = url_argument_spec()
+    argument_spec.update(dict(
+        nodes_nb=dict(type='int', default=1),
+        node_name=dict(type='str'),
+        states=dict(type='list', default=[]),
+        fail_states=dict(type='list', default=[]),
+        wait=dict(type='int', default=30),
+        timeout=dict(type='int', default=900),
+        retry_delay=dict(type='int', default=5),
+        auth_retries=dict(type='int', default=3),
+    ))
+    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
+    module.params['force_basic_auth'] = True
+
+    start = time.time()
+    since = None
+    while True:
+        # Only provisioning states are needed while waiting
+        query = {'fields': 'provision_state'}
+        if since is not None:
+            # Only return once status changed after last revision seen
+            query.update(wait=module.params['wait'], since=since)
+        status, since, result = fetch_status(module, query, start)
+        if status_reached(module.params, status):
+            # Final full status
+            status, since, result = fetch_status(module, {}, start)
+            module.exit_json(**result)
+        if result['elapsed'] >= module.params['timeout']:
+            module.fail_json(msg='Timeout waiting for nodes status', **result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+'''
+
+In-process stand-in for the Ironic and keystone services used by the
+register-helper utility (ansible/files/register_helper.py) through shade
+
+Only the subset of shade OperatorCloud used by the utility is implemented:
+list_machines, get_machine, list_nics_for_machine, patch_machine,
+node_set_provision_state, unregister_machine
+
+Example usage:
+
+from fake_ironic import FakeCloud, fake_shade
+cloud = FakeCloud(100, latency=0.005, failure_rate=0.01)
+sys.modules['shade'] = fake_shade(cloud)
+# Several Ironic endpoints (node indexes must not overlap)
+sys.modules['shade'] = fake_shade(cloud, {'http://row2:6385/': FakeCloud(100, first=100)})
+
+Nodes are synthetic (2 NICs each), either created at once (active by default)
+or enrolled later on (see enroll). Provisioning actions go through the
+transitional state of real Ironic (e.g. manage: verifying then manageable)
+which lasts transition_time seconds. Each call waits latency seconds (round
+trip to Ironic) and fails (HTTP 503) with probability failure_rate. If users
+are given, credentials of clouds built with a username are checked like
+keystone would (HTTP 401 on each call otherwise)
+
+'''
+
+from __future__ import print_function
+
+import collections
+import datetime
+import random
+import threading
+import time
+import types
+import uuid as uuidlib
+
+
+# Provisioning actions: action -> (allowed states, transitional state, final state)
+provision_actions = {
+    'manage': (['enroll', 'manageable', 'available'], 'verifying', 'manageable'),
+    'provide': (['manageable'], 'cleaning', 'available'),
+    'active': (['available'], 'deploying', 'active'),
+    'deleted': (['active', 'deploy failed', 'error'], 'deleting', 'available'),
+}
+# States in which nodes can be deleted
+deletable_states = ['enroll', 'manageable', 'available', 'adopt failed']
+
+
+class FakeIronicError(Exception):
+    ''' Error returned by fake Ironic or keystone (with HTTP status like shade exceptions) '''
+
+    def __init__(self, http_status, message):
+        super(FakeIronicError, self).__init__(message)
+        self.http_status = http_status
+
+
+# Timestamp of Ironic changes (created_at and updated_at fields)
+def _timestamp():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
+
+
+# Synthetic Ironic node as returned by shade
+def _fake_node(idx, state='active'):
+    return {
+        'uuid': str(uuidlib.UUID(int=idx + 1)),
+        'name': None,
+        'provision_state': state,
+        'power_state': 'power on' if state == 'active' else 'power off',
+        'target_provision_state': None,
+        'target_power_state': None,
+        'last_error': None,
+        'properties': {'cpus': 8, 'local_gb': 100, 'memory_mb': 16384},
+        'extra': {},
+        'driver_info': {},
+        'links': [],
+        'ports': [],
+        'created_at': _timestamp(),
+        'updated_at': None,
+    }
+
+
+# NICs of a synthetic node (2 per node, uppercase like some BMCs report them)
+def _fake_nics(idx):
+    return [{'address': '52:54:{:02X}:{:02X}:{:02X}:{:02X}'.format(
+        nic, (idx >> 16) & 0xff, (idx >> 8) & 0xff, idx & 0xff)} for nic in range(2)]
+
+
+class FakeCloud(object):
+    ''' Minimal in-memory stand-in for shade OperatorCloud '''
+
+    def __init__(self, size, latency=0.0, failure_rate=0.0, transition_time=0.0, users=None, state='active',
+                 first=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.transition_time = transition_time
+        # Keystone users: name -> password (credentials are not checked if None)
+        self.users = users
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.nics = {}
+        # Calls per method and failures injected
+        self.calls = collections.Counter()
+        self.failures = collections.Counter()
+        for idx in range(first, first + size):
+            self.enroll(idx, state)
+
+    # Add synthetic node of given index (e.g. enrolled by bifrost): returns its UUID
+    def enroll(self, idx, state='enroll'):
+        node = _fake_node(idx, state)
+        with self.lock:
+            self.nodes[node['uuid']] = node
+            self.nics[node['uuid']] = _fake_nics(idx)
+        return node['uuid']
+
+    # Simulated round trip to Ironic API (and failures injected)
+    def _call(self, method='call'):
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.failures[method] += 1
+            raise FakeIronicError(503, 'Injected failure of {}'.format(method))
+
+    # Complete transition of node once transitional state lasted long enough
+    def _advance(self, node):
+        pending = node.get('_pending')
+        if pending and pending[1] <= time.time():
+            node['provision_state'] = pending[0]
+            node['target_provision_state'] = None
+            node['power_state'] = 'power on' if pending[0] == 'active' else 'power off'
+            node['updated_at'] = _timestamp()
+            del node['_pending']
+        return node
+
+    # Node of given UUID (None if unknown like shade)
+    def _node(self, uuid):
+        node = self.nodes.get(uuid)
+        return self._advance(node) if node is not None else None
+
+    # Like shade.operator_cloud: keystone checks credentials (if users are
+    # defined and a username is given) when the cloud is built
+    def operator_cloud(self, **opts):
+        self._call('authenticate')
+        auth = opts.get('auth') or {}
+        if self.users is not None and 'username' in auth and self.users.get(auth['username']) != auth.get('password'):
+            return UnauthorizedCloud()
+        return self
+
+    # Like Ironic node list, only summary fields are returned
+    def list_machines(self):
+        self._call('list_machines')
+        with self.lock:
+            return [dict((k, n[k]) for k in ('uuid', 'name', 'provision_state', 'power_state'))
+                    for n in map(self._advance, self.nodes.values())]
+
+    def get_machine(self, uuid):
+        self._call('get_machine')
+        with self.lock:
+            node = self._node(uuid)
+            return dict((k, v) for k, v in node.items() if not k.startswith('_')) if node else None
+
+    def list_nics_for_machine(self, uuid):
+        self._call('list_nics_for_machine')
+        with self.lock:
+            if uuid not in self.nics:
+                raise FakeIronicError(404, 'Node {} could not be found'.format(uuid))
+            return list(self.nics[uuid])
+
+    # JSON patch (add, replace and remove operations)
+    def patch_machine(self, uuid, patch):
+        self._call('patch_machine')
+        with self.lock:
+            node = self._node(uuid)
+            if node is None:
+                raise FakeIronicError(404, 'Node {} could not be found'.format(uuid))
+            for op in patch:
+                path = op['path'].strip('/').split('/')
+                parent = node
+                for key in path[:-1]:
+                    parent = parent.setdefault(key, {})
+                if op['op'] == 'remove':
+                    parent.pop(path[-1], None)
+                else:
+                    parent[path[-1]] = op['value']
+            node['updated_at'] = _timestamp()
+            return dict((k, v) for k, v in node.items() if not k.startswith('_'))
+
+    def node_set_provision_state(self, uuid, state):
+        self._call('node_set_provision_state')
+        with self.lock:
+            node = self._node(uuid)
+            if node is None:
+                raise FakeIronicError(404, 'Node {} could not be found'.format(uuid))
+            if state not in provision_actions or node['provision_state'] not in provision_actions[state][0]:
+                raise FakeIronicError(400, 'The requested action "{}" can not be performed on node {} '
+                                      'while it is in state "{}"'.format(state, uuid, node['provision_state']))
+            allowed, transitional, final = provision_actions[state]
+            node['provision_state'] = transitional
+            node['target_provision_state'] = final
+            node['_pending'] = (final, time.time() + self.transition_time)
+            node['updated_at'] = _timestamp()
+            self._advance(node)
+            return dict((k, v) for k, v in node.items() if not k.startswith('_'))
+
+    # Delete node (and its ports)
+    def unregister_machine(self, nics, uuid, wait=False):
+        self._call('unregister_machine')
+        with self.lock:
+            node = self._node(uuid)
+            if node is None:
+                raise FakeIronicError(404, 'Node {} could not be found'.format(uuid))
+            if node['provision_state'] not in deletable_states:
+                raise FakeIronicError(409, 'Can not delete node {} in state "{}"'.format(
+                    uuid, node['provision_state']))
+            del self.nodes[uuid]
+            del self.nics[uuid]
+
+
+class UnauthorizedCloud(object):
+    ''' Cloud built with invalid credentials: all calls are rejected '''
+
+    def __getattr__(self, name):
+        def rejected(*args, **kwargs):
+            raise FakeIronicError(401, 'The request you have made requires authentication')
+        return rejected
+
+
+# Fake shade module whose clouds are given fake cloud (or the one of the
+# Ironic endpoint requested: URL -> fake cloud)
+def fake_shade(cloud, endpoints=None):
+    module = types.ModuleType('shade')
+
+    def operator_cloud(**opts):
+        endpoint = (opts.get('auth') or {}).get('endpoint')
+        return (endpoints or {}).get(endpoint, cloud).operator_cloud(**opts)
+    module.operator_cloud = operator_cloud
+    return module
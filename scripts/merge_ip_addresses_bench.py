@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+'''
+
+Micro-benchmark of the merge_ip_addresses and free_ip_* filters
+(ansible/playbooks/filter_plugins/merge_ip_addresses_filter.py)
+
+Example usage:
+
+merge_ip_addresses_bench.py --entries 10000 --range-prefix 8
+merge_ip_addresses_bench.py --entries 1000 --range-prefix 24 --source old/merge_ip_addresses_filter.py
+merge_ip_addresses_bench.py --entries 10000 --filter free_ip_ranges
+
+Synthetic reserved IPs are a mix of single addresses (IPv4 and IPv6) and
+address ranges: one range out of ten covers a whole network of the given
+prefix length (e.g. 16M addresses for /8), other ones a few addresses, some of
+them overlapping or adjacent. Part of the single addresses belong to ranges
+
+Another version of the filter can be benchmarked with --source (e.g. one
+extracted from git history, expanding ranges into lists of addresses: use
+small ranges then)
+
+Free addresses and ranges are computed for a /8 IPv4 network and a /64
+IPv6 one (first 100 addresses of each network for free_ip_addresses)
+
+Prints one line per size with the average and best timings and the number of
+entries returned
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import time
+
+script_base_dir = os.path.dirname(os.path.realpath(__file__))
+filter_source = os.path.realpath(os.path.join(
+    script_base_dir, '..', 'ansible', 'playbooks', 'filter_plugins', 'merge_ip_addresses_filter.py'))
+
+
+# Load filter module from given source file
+def load_filter(source=filter_source):
+    module_name = 'merge_ip_addresses_bench_filter'
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(module_name, source)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:
+        import imp
+        module = imp.load_source(module_name, source)
+    return module
+
+
+# Dotted IPv4 address of integer
+def ipv4(value):
+    return '.'.join(str((value >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+
+# Synthetic list of reserved IPs and ranges (10% ranges, 1 range out of 10
+# spanning a network of given prefix length)
+def fake_reserved_ips(count, range_prefix, seed=0):
+    rnd = random.Random(seed)
+    ips = []
+    big_size = 2 ** (32 - range_prefix)
+    for idx in range(count):
+        if idx % 10 == 0:
+            if idx % 100 == 0:
+                # Network sized range (anywhere in 10.0.0.0/8 for prefixes >= 8)
+                start = (10 << 24) + rnd.randrange(0, 2 ** 24, big_size) if range_prefix >= 8 else 0
+                ips.append('{},{}'.format(ipv4(start), ipv4(start + big_size - 1)))
+            else:
+                # Small range, may overlap or be adjacent to others
+                start = (10 << 24) + rnd.randrange(2 ** 24 - 64)
+                ips.append('{},{}'.format(ipv4(start), ipv4(start + rnd.randrange(1, 64))))
+        elif idx % 10 == 1:
+            ips.append('fd00::{:x}'.format(rnd.randrange(2 ** 16)))
+        else:
+            ips.append(ipv4((10 << 24) + rnd.randrange(2 ** 24)))
+    return ips
+
+
+def main():
+    parser = argparse.ArgumentParser(description='merge_ip_addresses and free_ip_* filters micro-benchmark')
+    parser.add_argument('--entries', default='1000,10000',
+                        help='comma separated list of reserved IPs list sizes')
+    parser.add_argument('--range-prefix', type=int, default=8,
+                        help='prefix length of the networks spanned by large ranges')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of measured runs per size')
+    parser.add_argument('--source', default=filter_source,
+                        help='merge_ip_addresses_filter.py version to benchmark')
+    parser.add_argument('--filter', choices=['merge_ip_addresses', 'free_ip_addresses', 'free_ip_ranges'],
+                        default='merge_ip_addresses', help='filter to benchmark')
+    args = parser.parse_args()
+
+    module = load_filter(args.source)
+    networks = ['10.0.0.0/8', 'fd00::/64']
+    filter_args = {
+        'merge_ip_addresses': [networks],
+        'free_ip_addresses': [networks, 100],
+        'free_ip_ranges': [networks],
+    }[args.filter]
+    print('{:>8} {:>12} {:>12} {:>8}'.format('entries', 'avg (ms)', 'best (ms)', 'returned'))
+    for size in [int(x) for x in args.entries.split(',')]:
+        ips = fake_reserved_ips(size, args.range_prefix)
+        timings = []
+        for idx in range(args.repeat):
+            start = time.time()
+            result = module.FilterModule().filters()[args.filter](list(ips), *filter_args)
+            timings.append(time.time() - start)
+        if isinstance(result, dict):
+            result = [x for values in result.values() for x in values]
+        print('{:>8} {:>12.2f} {:>12.2f} {:>8}'.format(
+            size, 1000.0 * sum(timings) / len(timings), 1000.0 * min(timings), len(result)))
+
+
+if __name__ == '__main__':
+    main()
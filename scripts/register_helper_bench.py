@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+'''
+
+Micro-benchmarks for the register-helper utility (ansible/files/register_helper.py)
+
+Example usage:
+
+register_helper_bench.py poll --sizes 10,100,1000
+register_helper_bench.py poll --sizes 100 --latency 20
+register_helper_bench.py poll --sizes 1000 --log-level INFO
+register_helper_bench.py poll --sizes 1000 --log-level INFO --source old/register_helper.py
+
+The utility is loaded from a temporary copy (so that its persistence files do not
+pollute the source tree) with the shade library replaced by an in-memory fake
+cloud holding the requested number of synthetic Ironic nodes (see fake_ironic.py)
+
+Logs are discarded unless a level is given: records of that level are then
+formatted and written to /dev/null (like a production logger). Another version
+of the utility can be benchmarked with --source (e.g. one extracted from git
+history to compare CPU usage before and after a change)
+
+Each scenario prints one line per size with the average and best timings and
+the average CPU time used by the process (all threads)
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from fake_ironic import FakeCloud, fake_shade
+
+script_base_dir = os.path.dirname(os.path.realpath(__file__))
+helper_source = os.path.realpath(os.path.join(
+    script_base_dir, '..', 'ansible', 'files', 'register_helper.py'))
+
+
+# CPU time of the process (python 2 clock is CPU time on Unix)
+process_time = getattr(time, 'process_time', None) or time.clock
+
+
+# Ironic endpoint URL of fake shard
+def shard_endpoint(name):
+    return 'http://{}:6385/'.format(name)
+
+
+# Load register_helper from a temporary copy with a fake shade module
+# (optionally with a copy of a persistence store, another version of the
+# utility, a logger writing records of given level to /dev/null and several
+# Ironic endpoints: name -> fake cloud)
+def load_helper(cloud, restore=True, persist_file=None, source=helper_source, log_level=None, shards=None):
+    endpoints = dict((shard_endpoint(name), shard_cloud) for name, shard_cloud in (shards or {}).items())
+    sys.modules['shade'] = fake_shade(cloud, endpoints)
+    work_dir = tempfile.mkdtemp(prefix='register_helper_bench_')
+    helper_copy = os.path.join(work_dir, 'register_helper.py')
+    shutil.copy(source, helper_copy)
+    if persist_file:
+        shutil.copy(persist_file, os.path.join(work_dir, 'register_helper.sqlite'))
+    module_name = 'register_helper_bench_{}'.format(len(cloud.nodes))
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(module_name, helper_copy)
+        helper = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(helper)
+    except ImportError:
+        import imp
+        helper = imp.load_source(module_name, helper_copy)
+    if log_level is None:
+        # Records are not written to the terminal
+        helper.app.logger.handlers = [logging.NullHandler()]
+    else:
+        handler = logging.StreamHandler(open(os.devnull, 'w'))
+        handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s'))
+        helper.app.logger.handlers = [handler]
+        helper.app.logger.setLevel(log_level)
+    if shards:
+        helper.shards = collections.OrderedDict(
+            (name, dict(auth_type='None', auth=dict(endpoint=shard_endpoint(name)))) for name in sorted(shards))
+    if restore:
+        # State restored without background warm-up nor polling
+        helper._restore_state()
+    return helper, work_dir
+
+
+# Pending registrations for 10% of the nodes
+def _fake_todo(cloud):
+    todo = {}
+    for idx, uuid in enumerate(sorted(cloud.nodes.keys())):
+        if idx % 10:
+            continue
+        vid = 'virt-{}'.format(idx)
+        todo[vid] = {
+            'virt-uuid': vid,
+            'name': 'node-{}'.format(idx),
+            'mac_addr': cloud.nics[uuid][0]['address'].lower(),
+        }
+    return todo
+
+
+# Full poll cycle: inventory refresh, MAC matching of pending registrations
+# and persistence
+def bench_poll(helper, cloud):
+    def run():
+        helper.todo_machines.clear()
+        helper.todo_machines.update(_fake_todo(cloud))
+        helper._get_shade_infos()
+    return run
+
+
+# Single MAC address lookup
+def bench_find(helper, cloud):
+    macs = [nics[-1]['address'] for nics in cloud.nics.values()]
+
+    def run():
+        for mac in macs:
+            helper._find_machine(mac)
+    return run
+
+
+# HTTP basic authentication checks against keystone (same credentials)
+def bench_auth(helper, cloud):
+    helper.shade_opts['auth_type'] = 'password'
+
+    def run():
+        for idx in range(100):
+            helper.verify_password('bench', 'secret')
+    return run
+
+
+# Persistence of a single modified machine
+def bench_persist(helper, cloud):
+    uuids = sorted(helper.registered_machines.keys())
+
+    def run():
+        for uuid in uuids[:10]:
+            helper.registered_machines[uuid]['agent-last-seen-ts'] = time.time()
+            helper._mark_dirty('registered', uuid)
+            helper._update_persisted_objects()
+    return run
+
+
+# GET /status requests (all nodes registered) without inventory change
+def bench_status(helper, cloud):
+    for idx, uuid in enumerate(sorted(cloud.nodes.keys())):
+        helper.todo_machines['virt-{}'.format(idx)] = {
+            'virt-uuid': 'virt-{}'.format(idx),
+            'name': 'node-{}'.format(idx),
+            'mac_addr': cloud.nics[uuid][0]['address'],
+        }
+    helper._get_shade_infos()
+    client = helper.app.test_client()
+
+    def run():
+        for idx in range(100):
+            client.get('/status')
+    return run
+
+
+scenarios = {
+    'auth': bench_auth,
+    'poll': bench_poll,
+    'find': bench_find,
+    'persist': bench_persist,
+    'status': bench_status,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='register-helper micro-benchmarks')
+    parser.add_argument('scenario', choices=sorted(scenarios.keys()))
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='comma separated list of synthetic node counts')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of measured runs per size')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated Ironic round trip time in milliseconds')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='level of logs written to /dev/null (discarded if not set)')
+    parser.add_argument('--source', default=helper_source,
+                        help='register_helper.py version to benchmark')
+    args = parser.parse_args()
+
+    print('{:>8} {:>12} {:>12} {:>12}'.format('nodes', 'avg (ms)', 'best (ms)', 'cpu (ms)'))
+    for size in [int(x) for x in args.sizes.split(',')]:
+        cloud = FakeCloud(size, args.latency / 1000.0)
+        helper, work_dir = load_helper(cloud, source=args.source, log_level=args.log_level)
+        timings = []
+        cpu_timings = []
+        try:
+            # Warm up: initial discovery of all nodes
+            helper._get_shade_infos()
+            run = scenarios[args.scenario](helper, cloud)
+            for idx in range(args.repeat):
+                start, cpu_start = time.time(), process_time()
+                run()
+                timings.append(time.time() - start)
+                cpu_timings.append(process_time() - cpu_start)
+        finally:
+            helper._close_pools()
+            helper.persist_db.close()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print('{:>8} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+            size, 1000.0 * sum(timings) / len(timings), 1000.0 * min(timings),
+            1000.0 * sum(cpu_timings) / len(cpu_timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+'''
+
+Load test of the register-helper utility: concurrent pollers of /status
+while Ironic inventory is being polled and new nodes are registered and
+provisioned
+
+Example usage:
+
+register_helper_load.py --server async --pollers 200 --nodes 1000 --latency 2
+register_helper_load.py --server flask --pollers 200 --nodes 1000 --latency 2
+register_helper_load.py --nodes 500 --register 100 --transition-time 1 --failure-rate 0.01 --auth
+register_helper_load.py --nodes 3000 --shards 3 --register 60
+
+The utility is loaded like in register_helper_bench.py (temporary copy, fake
+Ironic of fake_ironic.py) and served on a local port either by the asyncio
+serving mode (ansible/files/register_helper_async.py) or by the threaded Flask
+development server (with threads polling Ironic and driving nodes). Ironic
+inventory is polled continuously (unless a poll interval is given) while some
+nodes change power state, so that /status views are regularly rebuilt
+
+Nodes to register are enrolled into Ironic at the given arrival rate and
+registered right away (POST /register), the utility then drives them up to the
+active state. A watcher long-polls /status (like register_helper_status
+module) to time when each node is seen active
+
+With --auth, keystone checks credentials of HTTP clients (cached by the
+utility) and Ironic calls fail at the given rate
+
+With --shards, nodes are spread over several fake Ironic endpoints (like
+several bifrost deployments) polled independently by the utility
+
+Prints the number of requests and polls performed, /status latency, poll cycle
+time (from Ironic list to inventory merged) and time to active percentiles
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+
+import aiohttp
+
+from fake_ironic import FakeCloud
+from register_helper_bench import load_helper, script_base_dir
+
+sys.path.insert(0, os.path.realpath(os.path.join(script_base_dir, '..', 'ansible', 'files')))
+
+
+# Serve helper with asyncio serving mode in a separate thread
+def serve_async(helper):
+    from aiohttp import web
+    import register_helper_async
+
+    started = threading.Event()
+    state = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(register_helper_async.AsyncRegisterHelper(helper).make_app())
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        state['port'] = site._server.sockets[0].getsockname()[1]
+        state['stop'] = lambda: loop.call_soon_threadsafe(loop.stop)
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    started.wait()
+
+    def stop():
+        state['stop']()
+        thread.join()
+    return state['port'], stop
+
+
+# Serve helper with threaded Flask development server (and polling and
+# driving threads)
+def serve_flask(helper):
+    from werkzeug.serving import make_server
+
+    # Requests are not logged
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, helper.app, threaded=True)
+    running = threading.Event()
+    running.set()
+
+    def poll():
+        while running.is_set():
+            start = time.time()
+            helper._get_shade_infos()
+            time.sleep(max(0, helper.poll_interval - (time.time() - start)))
+
+    def drive():
+        while running.is_set():
+            helper._drive_nodes()
+            time.sleep(helper.driver_interval)
+
+    threads = [threading.Thread(target=server.serve_forever), threading.Thread(target=poll),
+               threading.Thread(target=drive)]
+    for thread in threads:
+        thread.start()
+
+    def stop():
+        running.clear()
+        server.shutdown()
+        for thread in threads:
+            thread.join()
+    return server.server_port, stop
+
+
+servers = {
+    'async': serve_async,
+    'flask': serve_flask,
+}
+
+
+# Change power state of some nodes from time to time
+def churn(clouds, running, ratio):
+    nodes = [cloud.nodes[uuid] for cloud in clouds for uuid in sorted(cloud.nodes.keys())]
+    while running.is_set():
+        for node in random.sample(nodes, max(1, int(len(nodes) * ratio))):
+            node['power_state'] = 'power off' if node['power_state'] == 'power on' else 'power on'
+        time.sleep(0.5)
+
+
+# Enroll nodes into Ironic (clouds in turn) and register them at given rate
+# (nodes per second), recording registration times by name
+async def registrar(session, url, clouds, first_idx, count, rate, registered, errors):
+    for idx in range(first_idx, first_idx + count):
+        cloud = clouds[idx % len(clouds)]
+        uuid = cloud.enroll(idx)
+        name = 'load-node-{}'.format(idx)
+        registered[name] = time.time()
+        record = {'virt-uuid': 'virt-{}'.format(idx), 'name': name, 'mac_addr': cloud.nics[uuid][0]['address']}
+        try:
+            async with session.post(url, json=record) as resp:
+                await resp.read()
+                if resp.status != 201:
+                    errors.append(resp.status)
+        except aiohttp.ClientError as e:
+            errors.append(str(e))
+        await asyncio.sleep(1.0 / rate)
+
+
+# Watch provisioning states (long polling) until deadline or all registered
+# nodes are active, recording first time each node is seen active
+async def watcher(session, url, deadline, count, active, errors):
+    loop = asyncio.get_event_loop()
+    since = None
+    while loop.time() < deadline and len(active) < count:
+        params = {'fields': 'provision_state'}
+        if since is not None:
+            params.update(wait=max(1, int(deadline - loop.time())), since=since)
+        try:
+            async with session.get(url, params=params) as resp:
+                status = await resp.json()
+                since = resp.headers.get('X-Inventory-Revision')
+        except aiohttp.ClientError as e:
+            errors.append(str(e))
+            await asyncio.sleep(1)
+            continue
+        for name, node in status.items():
+            if node.get('provision_state') == 'active' and name not in active:
+                active[name] = time.time()
+
+
+# Poll /status until deadline, recording latencies
+async def poller(session, url, deadline, latencies, errors):
+    loop = asyncio.get_event_loop()
+    while loop.time() < deadline:
+        start = loop.time()
+        try:
+            async with session.get(url) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    errors.append(resp.status)
+                    continue
+        except aiohttp.ClientError as e:
+            errors.append(str(e))
+            continue
+        latencies.append(loop.time() - start)
+
+
+async def run_clients(base_url, args, clouds, results):
+    connector = aiohttp.TCPConnector(limit=0)
+    auth = aiohttp.BasicAuth('load', 'secret') if args.auth else None
+    async with aiohttp.ClientSession(connector=connector, auth=auth) as session:
+        deadline = asyncio.get_event_loop().time() + args.duration
+        clients = [poller(session, base_url + '/status', deadline, results['latencies'], results['errors'])
+                   for idx in range(args.pollers)]
+        if args.register > 0:
+            clients.append(registrar(session, base_url + '/register', clouds, args.nodes, args.register,
+                                     args.arrival_rate, results['registered'], results['errors']))
+            clients.append(watcher(session, base_url + '/status', deadline, args.register,
+                                   results['active'], results['errors']))
+        await asyncio.gather(*clients)
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+# Line of percentiles of values (multiplied by scale)
+def print_percentiles(label, values, scale=1.0):
+    values = sorted(values)
+    if values:
+        print('{:<18} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            label, *[scale * percentile(values, pct) for pct in [50, 90, 99, 100]]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='register-helper /status load test')
+    parser.add_argument('--server', choices=sorted(servers.keys()), default='async')
+    parser.add_argument('--pollers', type=int, default=200,
+                        help='number of concurrent /status pollers')
+    parser.add_argument('--nodes', type=int, default=1000,
+                        help='number of synthetic Ironic nodes')
+    parser.add_argument('--latency', type=float, default=2.0,
+                        help='simulated Ironic round trip time in milliseconds')
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help='ratio of nodes changing power state every 0.5 second')
+    parser.add_argument('--duration', type=float, default=20.0,
+                        help='duration of the test in seconds')
+    parser.add_argument('--poll-interval', type=float, default=0.0,
+                        help='interval between polls of Ironic in seconds (continuous polls by default)')
+    parser.add_argument('--register', type=int, default=0,
+                        help='number of nodes enrolled, registered and provisioned during the test')
+    parser.add_argument('--arrival-rate', type=float, default=10.0,
+                        help='number of nodes registered per second')
+    parser.add_argument('--transition-time', type=float, default=1.0,
+                        help='time spent by nodes in Ironic transitional states in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='ratio of failed Ironic calls')
+    parser.add_argument('--auth', action='store_true',
+                        help='check credentials of HTTP clients against keystone')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='number of Ironic endpoints the nodes are spread over')
+    args = parser.parse_args()
+
+    shard_size = args.nodes // args.shards
+    clouds = [FakeCloud(shard_size if idx < args.shards - 1 else args.nodes - idx * shard_size,
+                        args.latency / 1000.0, failure_rate=args.failure_rate,
+                        transition_time=args.transition_time, users={'load': 'secret'} if args.auth else None,
+                        first=idx * shard_size)
+              for idx in range(args.shards)]
+    shards = None
+    if args.shards > 1:
+        shards = dict(('row{}'.format(idx), cloud) for idx, cloud in enumerate(clouds))
+    helper, work_dir = load_helper(clouds[0], shards=shards)
+    helper.poll_interval = args.poll_interval
+    if args.auth:
+        helper.shade_opts['auth_type'] = 'password'
+    # Time poll cycles (of each shard): from Ironic list to inventory merged
+    polls = []
+    poll_start = {}
+    fetch = helper._fetch_shade_infos
+    merge = helper._merge_shade_infos
+
+    def timed_fetch(shard=''):
+        poll_start[shard] = time.time()
+        return fetch(shard)
+
+    def timed_merge(machines, all_nics, shard=''):
+        merge(machines, all_nics, shard)
+        polls.append(time.time() - poll_start[shard])
+    helper._fetch_shade_infos = timed_fetch
+    helper._merge_shade_infos = timed_merge
+
+    results = {'latencies': [], 'errors': [], 'registered': {}, 'active': {}}
+    running = threading.Event()
+    running.set()
+    churner = threading.Thread(target=churn, args=(clouds, running, args.churn))
+    port, stop = servers[args.server](helper)
+    churner.start()
+    try:
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run_clients('http://127.0.0.1:{}'.format(port), args, clouds, results))
+        loop.close()
+    finally:
+        running.clear()
+        churner.join()
+        stop()
+        helper._close_pools()
+        helper.persist_db.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    latencies = results['latencies']
+    print('server: {} pollers: {} nodes: {} polls: {} requests: {} errors: {} ({:.0f} req/s)'.format(
+        args.server, args.pollers, args.nodes, len(polls), len(latencies), len(results['errors']),
+        len(latencies) / args.duration))
+    print('{:<18} {:>10} {:>10} {:>10} {:>10}'.format('', 'p50', 'p90', 'p99', 'max'))
+    print_percentiles('/status (ms)', latencies, 1000.0)
+    print_percentiles('poll cycle (ms)', polls, 1000.0)
+    if args.register > 0:
+        to_active = [ts - results['registered'][name] for name, ts in results['active'].items()]
+        print_percentiles('to active (s)', to_active)
+        print('registered: {} active: {}'.format(len(results['registered']), len(results['active'])))
+    calls = sum((cloud.calls for cloud in clouds), collections.Counter())
+    failures = sum(sum(cloud.failures.values()) for cloud in clouds)
+    print('Ironic calls: {} (failures injected: {})'.format(
+        ', '.join('{} {}'.format(k, v) for k, v in sorted(calls.items())), failures))
+
+
+if __name__ == '__main__':
+    main()
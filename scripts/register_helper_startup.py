@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+
+Startup time of the register-helper utility (ansible/files/register_helper.py)
+
+Example usage:
+
+register_helper_startup.py --sizes 100,1000 --latency 5
+
+For each size, the utility is started from the persistence store left by a
+previous run (see register_helper_bench.py for the fake cloud used):
+- eager: Ironic is synchronized before serving requests (former behaviour)
+- lazy: application factory, Ironic is synchronized in background
+
+Prints the time until the first /status response and until the utility is
+ready (Ironic synchronized, /healthz answering 200)
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import time
+
+from register_helper_bench import FakeCloud, load_helper
+
+
+# Start utility and return (time to first response, time to ready)
+def start(cloud, persist_file, mode):
+    start_ts = time.time()
+    helper, work_dir = load_helper(cloud, restore=False, persist_file=persist_file)
+    try:
+        if mode == 'eager':
+            helper._restore_state()
+            helper._warm_up()
+        else:
+            helper.create_app()
+        client = helper.app.test_client()
+        resp = client.get('/status')
+        first = time.time() - start_ts
+        assert resp.status_code == 200
+        if mode == 'lazy':
+            helper.warm_up_thread.join()
+        assert client.get('/healthz').status_code == 200
+        ready = time.time() - start_ts
+    finally:
+        if helper.scheduler.running:
+            helper.scheduler.shutdown(wait=False)
+        helper._close_pools()
+        helper.persist_db.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return first, ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description='register-helper startup time')
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='comma separated list of synthetic node counts')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of measured startups per size and mode')
+    parser.add_argument('--latency', type=float, default=5.0,
+                        help='simulated Ironic round trip time in milliseconds')
+    args = parser.parse_args()
+
+    print('{:>8} {:>6} {:>16} {:>16}'.format('nodes', 'mode', 'first resp (ms)', 'ready (ms)'))
+    for size in [int(x) for x in args.sizes.split(',')]:
+        cloud = FakeCloud(size, args.latency / 1000.0)
+        # Persistence store of a previous run
+        helper, work_dir = load_helper(cloud)
+        try:
+            helper._get_shade_infos()
+            helper._close_pools()
+            helper.persist_db.close()
+            persist_file = os.path.join(work_dir, 'register_helper.sqlite')
+            for mode in ['eager', 'lazy']:
+                timings = [start(cloud, persist_file, mode) for idx in range(args.repeat)]
+                print('{:>8} {:>6} {:>16.1f} {:>16.1f}'.format(
+                    size, mode, 1000.0 * min(t[0] for t in timings), 1000.0 * min(t[1] for t in timings)))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()